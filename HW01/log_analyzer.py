@@ -1,20 +1,81 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
 import gzip
+import heapq
+import io
+import itertools
+import math
+import mmap
+import multiprocessing
 import re
 import json
 import os
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from optparse import OptionParser
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # log_format ui_short '$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
+UI_SHORT_FORMAT = ('$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
+                   '$status $body_bytes_sent "$http_referer" '
+                   '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+                   '$request_time')
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "LOG_FORMAT": UI_SHORT_FORMAT,
+    "MEDIAN_MODE": "exact",
+    "WORKERS": 1,
+    "BLOCK_SIZE": 4 * 1024 * 1024,
+    "USE_MMAP": True,
+    "STATE_DIR": "./state",
+    "REPORT_DAYS": 1,
+    "PROCESS_ALL": False,
+    "LOG_WORKERS": 1,
+    "PERCENTILES": (90, 95, 99),
+    "USE_NUMPY": True,
+    "URL_STRIP_QUERY": False,
+    "URL_COLLAPSE_IDS": False,
+    "URL_RULES": (),
+    "COLUMN_CACHE": False,
+    "CACHE_DIR": "./cache",
+    "FOLLOW_LOG": "nginx-access-ui.log",
+    "FOLLOW_WINDOW": 3600,
+    "FOLLOW_SLOTS": 60,
+    "FOLLOW_REFRESH": 60,
+    "FOLLOW_POLL": 1.0,
 }
 
 FIELDS = (
@@ -32,19 +93,68 @@ FIELDS = (
     ('http_X_RB_USER', r'"(?P<http_X_RB_USER>.*)"'),
     ('request_time', r'(?P<request_time>\S+)'),
 )
-RE_PARSE_LINE = re.compile(r'\s+'.join(f[1] for f in FIELDS))
+RE_PARSE_LINE = re.compile(r'\s+'.join(f[1] for f in FIELDS).encode('ascii'))
+UI_SHORT_QUOTES = 2 * sum(1 for f in FIELDS if f[1].startswith('"'))
+RE_FORMAT_VARIABLE = re.compile(r'\$(\w+)')
+URL_VARIABLES = ('request', 'request_uri', 'uri')
+ADJACENT_VALUES = {'request_time': r'[0-9]*\.?[0-9]*', 'uri': r'[^?\s]*'}
 
 REPORT_TEMPLATE = 'report.html'
 LOG_NAME_PREFIX = 'nginx-access-ui.log-'
+RE_LOG_NAME = re.compile(r'^%s\d{8}(\.gz)?$' % re.escape(LOG_NAME_PREFIX))
+LOG_INDEX_NAME = 'log_index.state'
+GZIP_QUEUE_SIZE = 4
+GZIP_PUT_TIMEOUT = 0.1
+URL_CACHE_SIZE = 100000
+# columnar cache: header, url ids (uint32), request times (float32), urls
+CACHE_MAGIC = b'LACOLS01'
+CACHE_HEADER = struct.Struct('<8sQQQ')
+CACHE_TIME_DIGITS = 3
+URL_QUERY_RULE = (r'\?.*', '')
+URL_ID_RULES = (
+    (r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}', '{uuid}'),
+    (r'(?<=/)\d+(?=/|\?|$)', '{id}'),
+)
 
 def main(config):
-    last_log_name = get_last_log_name(config['LOG_DIR'])
-    if last_log_name:
-        report_name = os.path.join(config['REPORT_DIR'], 'report-%s.html' % get_date_from_file_name(last_log_name))
-        if not os.path.exists(report_name):
-            data, count_all, time_all = parse_file(os.path.join(config['LOG_DIR'], last_log_name))
-            result = calc_result(data, count_all, time_all, config['REPORT_SIZE'])
-            render_result(result, report_name)
+    # The newest REPORT_DAYS logs get a report; with PROCESS_ALL so does every
+    # log not processed yet, oldest first, each with the logs before it.
+    get_line_parser(config.get('LOG_FORMAT'))
+    state_dir = config.get('STATE_DIR')
+    if state_dir and not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    index_name = os.path.join(state_dir, LOG_INDEX_NAME) if state_dir else None
+    index = update_log_index(config['LOG_DIR'], load_state(index_name) if index_name else None)
+    log_names = get_last_log_names(config['LOG_DIR'], None, index)
+    days = config.get('REPORT_DAYS', 1)
+    windows = []
+    if config.get('PROCESS_ALL'):
+        windows = [log_names[i:i + days] for i in reversed(range(len(log_names)))
+                   if not index['logs'][log_names[i]]['processed']]
+    if log_names and log_names[:days] not in windows:
+        windows.append(log_names[:days])
+    stat_type = STAT_TYPES[config.get('MEDIAN_MODE', 'exact')]
+    for window in windows:
+        build_report(window, stat_type, config)
+        index['logs'][window[0]]['processed'] = True
+    if index_name:
+        save_state(index_name, index)
+
+
+def build_report(log_names, stat_type, config):
+    report_name = get_report_name(config['REPORT_DIR'], log_names)
+    # rotated .gz logs never change, a plain log may still be written to
+    if os.path.exists(report_name) and all(n.endswith('.gz') for n in log_names):
+        return
+    data, changed = {}, not os.path.exists(report_name)
+    for log_data, log_changed in load_logs_data(list(reversed(log_names)), stat_type, config):
+        merge_results(data, log_data)
+        changed = changed or log_changed
+    if changed:
+        count_all, time_all = get_totals(data)
+        result = calc_result(data, count_all, time_all, config['REPORT_SIZE'],
+                             config.get('PERCENTILES', ()), config.get('USE_NUMPY', False))
+        render_result(result, report_name)
 
 
 def get_date_from_file_name(file_name):
@@ -52,56 +162,1042 @@ def get_date_from_file_name(file_name):
     return '%s.%s.%s' % (tmp_date[:4], tmp_date[4:6], tmp_date[6:8])
 
 
+def scan_log_dir(log_dir, known=()):
+    # Names of dated logs. scandir tells files apart without a stat call per
+    # entry; without it only names not in known are checked with a stat.
+    if scandir is not None:
+        return [entry.name for entry in scandir(log_dir) if RE_LOG_NAME.match(entry.name) and entry.is_file()]
+    return [name for name in os.listdir(log_dir)
+            if RE_LOG_NAME.match(name) and (name in known or os.path.isfile(os.path.join(log_dir, name)))]
+
+
+def make_log_entry(name, st, processed=False):
+    return {'date': get_date_from_file_name(name), 'size': st.st_size, 'mtime': st.st_mtime, 'processed': processed}
+
+
+def update_log_index(log_dir, index=None):
+    # Index of the dated logs in log_dir: {'logs': {name: {date, size, mtime,
+    # processed}}, ...}. The directory is listed again only when its mtime
+    # changed, e.g. after a rotation. Known .gz logs are never stat-ed again,
+    # plain ones may grow and are stat-ed on every run.
+    if index is None or index.get('log_dir') != log_dir:
+        index = {'log_dir': log_dir, 'dir_mtime': None, 'logs': {}}
+    logs = index['logs']
+    dir_mtime = os.stat(log_dir).st_mtime
+    if dir_mtime != index['dir_mtime']:
+        names = scan_log_dir(log_dir, logs)
+        index['dir_mtime'] = dir_mtime
+    else:
+        names = list(logs)
+    found = {}
+    for name in names:
+        if name.endswith('.gz') and name in logs:
+            found[name] = logs[name]
+            continue
+        try:
+            st = os.stat(os.path.join(log_dir, name))
+        except OSError:
+            continue
+        found[name] = make_log_entry(name, st, logs[name]['processed'] if name in logs else False)
+    index['logs'] = found
+    return index
+
+
+def get_last_log_names(log_dir, count, index=None):
+    if index is None:
+        index = update_log_index(log_dir)
+    return sorted(index['logs'], reverse=True, key=get_date_from_file_name)[:count]
+
+
 def get_last_log_name(log_dir):
-    files = sorted([fn for fn in os.listdir(log_dir) if os.path.isfile(os.path.join(log_dir, fn))],
-        reverse=True, key=get_date_from_file_name)
+    files = get_last_log_names(log_dir, 1)
     if files:
         return files[0]
     return None
 
 
-def parse_file(file_name):
+def get_report_name(report_dir, log_names):
+    dates = sorted(get_date_from_file_name(n) for n in log_names)
+    if len(dates) == 1:
+        return os.path.join(report_dir, 'report-%s.html' % dates[0])
+    return os.path.join(report_dir, 'report-%s-%s.html' % (dates[0], dates[-1]))
+
+
+def get_state_name(state_dir, log_name, stat_type):
+    mode = [k for k, v in STAT_TYPES.items() if v is stat_type][0]
+    return os.path.join(state_dir, '%s.%s.state' % (log_name, mode))
+
+
+def load_state(state_name):
+    try:
+        with open(state_name, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def save_state(state_name, state):
+    tmp_name = state_name + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_name, state_name)
+
+
+def get_complete_size(file_name, block_size=64 * 1024):
+    # size of the file up to its last newline, i.e. without a line still being written
+    with open(file_name, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            pos = f.read(end - start).rfind(b'\n')
+            if pos >= 0:
+                return start + pos + 1
+            end = start
+    return 0
+
+
+def load_log_data(log_name, stat_type, config):
+    # Returns per-url aggregates of the log and whether anything was parsed.
+    # With STATE_DIR set they are stored per log: a .gz log is parsed once,
+    # a plain log is resumed from the offset it was parsed up to last time.
+    file_name = os.path.join(config['LOG_DIR'], log_name)
+    url_rules = get_url_rules(config)
+    state_dir = config.get('STATE_DIR')
+    if not state_dir:
+        return parse_log(file_name, stat_type, url_rules, config), True
+    state_name = get_state_name(state_dir, log_name, stat_type)
+    state = load_state(state_name)
+    if state is not None and state.get('url_rules', ()) != url_rules:
+        state = None
+    start = end = None
+    if file_name.endswith('.gz'):
+        if state is not None:
+            return state['data'], False
+    else:
+        end = get_complete_size(file_name)
+        if state is not None and state['offset'] > end:
+            state = None
+        start = state['offset'] if state is not None else 0
+        if start == end:
+            return state['data'] if state is not None else {}, False
+    data = parse_log(file_name, stat_type, url_rules, config, start or 0, end)
+    if state is not None:
+        data = merge_results(state['data'], data)
+    save_state(state_name, {'offset': end, 'url_rules': url_rules, 'data': data})
+    return data, True
+
+
+def parse_log(file_name, stat_type, url_rules, config, start=0, end=None):
+    # Whole logs go through the columnar cache when COLUMN_CACHE is on.
+    if config.get('COLUMN_CACHE') and not start:
+        cache_name = get_cache_name(config['CACHE_DIR'], file_name)
+        data = load_column_cache(cache_name, stat_type, url_rules)
+        if data is None:
+            if not os.path.isdir(config['CACHE_DIR']):
+                os.makedirs(config['CACHE_DIR'])
+            build_column_cache(file_name, cache_name, config['BLOCK_SIZE'], end, config.get('LOG_FORMAT'),
+                               config.get('WORKERS', 1), config.get('USE_MMAP', False))
+            data = load_column_cache(cache_name, stat_type, url_rules)
+        return data
+    return parse_files([file_name], stat_type, config.get('WORKERS', 1), config.get('BLOCK_SIZE'), start, end,
+                       config.get('USE_MMAP', False), url_rules, config.get('LOG_FORMAT'))[0]
+
+
+def get_cache_name(cache_dir, file_name):
+    st = os.stat(file_name)
+    return os.path.join(cache_dir, '%s.%d.%d.cols' % (os.path.basename(file_name), st.st_mtime, st.st_size))
+
+
+def build_column_cache(file_name, cache_name, block_size, end=None, log_format=None, workers=1, use_mmap=False):
+    # Parses the log into a url id (uint32) and a request_time (float32)
+    # column plus the url dictionary, so the log can be aggregated again in
+    # any mode without gzip and line parsing. end limits a plain log. The log
+    # is parsed by parse_files, with its workers and mmap reads; rows come
+    # grouped by url, each url's times still in log order.
+    data = parse_files([file_name], ExactStat, workers, block_size, 0, end, use_mmap, (), log_format)[0]
+    ids, times = array.array('I'), array.array('f')
+    urls = list(data)
+    for url_id, url in enumerate(urls):
+        url_times = data[url].times
+        ids.fromlist([url_id] * len(url_times))
+        times.fromlist(url_times.tolist())
+    url_bytes = b'\n'.join(urls)
+    tmp_name = cache_name + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, len(ids), len(urls), len(url_bytes)))
+        ids.tofile(f)
+        times.tofile(f)
+        f.write(url_bytes)
+    os.rename(tmp_name, cache_name)
+    remove_old_caches(file_name, cache_name)
+
+
+def remove_old_caches(file_name, cache_name):
+    # A log that is still written to gets a new cache name whenever it grows,
+    # the caches of its older versions are never read again.
+    cache_dir = os.path.dirname(cache_name)
+    pattern = re.compile(r'%s\.\d+\.\d+\.cols$' % re.escape(os.path.basename(file_name)))
+    for name in os.listdir(cache_dir or '.'):
+        path = os.path.join(cache_dir, name)
+        if path != cache_name and pattern.match(name):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load_column_cache(cache_name, stat_type, url_rules=()):
+    # Per-url aggregates from a columnar cache, None if there is no valid one.
+    # Times are rounded back to the millisecond resolution of request_time.
+    try:
+        f = open(cache_name, 'rb')
+    except IOError:
+        return None
+    with f:
+        # an empty file can't be mapped
+        if os.fstat(f.fileno()).st_size < CACHE_HEADER.size:
+            return None
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, lines, urls_count, urls_size = CACHE_HEADER.unpack_from(m)
+        times_at = CACHE_HEADER.size + 4 * lines
+        urls_at = times_at + 4 * lines
+        if magic != CACHE_MAGIC or len(m) != urls_at + urls_size:
+            return None
+        urls = m[urls_at:].split(b'\n') if urls_count else []
+        normalizer = get_url_normalizer(url_rules)
+        remap = None
+        if normalizer is not None:
+            # ids of the cached url dictionary to ids of the normalized urls
+            url_ids, remap = {}, []
+            for url in urls:
+                remap.append(url_ids.setdefault(normalizer.normalize(url), len(url_ids)))
+            urls = sorted(url_ids, key=url_ids.get)
+        if numpy is not None:
+            stats = aggregate_columns_numpy(m, lines, remap, len(urls), stat_type)
+        else:
+            stats = aggregate_columns(m, lines, remap, len(urls), stat_type)
+    finally:
+        m.close()
+    return dict((urls[i], stat) for i, stat in enumerate(stats) if stat is not None)
+
+
+def array_frombytes(arr, data):
+    # fromstring was renamed to frombytes in Python 3
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+
+
+def aggregate_columns(m, lines, remap, urls_count, stat_type):
+    ids, times = array.array('I'), array.array('f')
+    times_at = CACHE_HEADER.size + 4 * lines
+    array_frombytes(ids, m[CACHE_HEADER.size:times_at])
+    array_frombytes(times, m[times_at:times_at + 4 * lines])
+    stats = [None] * urls_count
+    for i in range(lines):
+        url_id = ids[i] if remap is None else remap[ids[i]]
+        stat = stats[url_id]
+        if stat is None:
+            stat = stats[url_id] = stat_type()
+        stat.add(round(times[i], CACHE_TIME_DIGITS))
+    return stats
+
+
+def aggregate_columns_numpy(m, lines, remap, urls_count, stat_type):
+    # A stable sort by url id groups the times without changing their log
+    # order, so exact stats come out the same as from parsing the log. Both
+    # columns are copied out of the map before it is closed.
+    times_at = CACHE_HEADER.size + 4 * lines
+    ids = numpy.frombuffer(m, dtype=numpy.uint32, count=lines, offset=CACHE_HEADER.size).astype(numpy.int64)
+    times = numpy.frombuffer(m, dtype=numpy.float32, count=lines, offset=times_at).astype(numpy.float64)
+    times = times.round(CACHE_TIME_DIGITS)
+    if remap is not None:
+        ids = numpy.asarray(remap, dtype=numpy.int64)[ids]
+    stats = [None] * urls_count
+    if not lines:
+        return stats
+    order = numpy.argsort(ids, kind='mergesort')
+    ids, times = ids[order], times[order]
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(ids)) + 1, [lines]))
+    for a, b in zip(starts[:-1], starts[1:]):
+        stat = stats[ids[a]] = stat_type()
+        if stat_type is ExactStat:
+            array_frombytes(stat.times, times[a:b].tobytes())
+        else:
+            for t in times[a:b].tolist():
+                stat.add(t)
+    return stats
+
+
+def load_logs_data(log_names, stat_type, config):
+    # load_log_data for each log in order; with LOG_WORKERS > 1 several logs
+    # (each decompressed and parsed by one worker) are processed at once.
+    log_workers = min(config.get('LOG_WORKERS', 1), len(log_names))
+    if log_workers <= 1:
+        for log_name in log_names:
+            yield load_log_data(log_name, stat_type, config)
+        return
+    # pool workers are daemonic and can't start pools of their own
+    log_config = dict(config, WORKERS=1)
+    pool = multiprocessing.Pool(log_workers)
+    try:
+        for res in pool.imap(run_task, [(load_log_data, n, stat_type, log_config) for n in log_names]):
+            yield res
+    finally:
+        pool.close()
+        pool.join()
+
+
+def msum_add(partials, x):
+    # Shewchuk's exact summation: partials always add up to the exact sum, so
+    # math.fsum(partials) is correctly rounded whatever order values came in.
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+def quantile_index(count, q):
+    return min(int(count * q), count - 1)
+
+
+class ExactStat(object):
+    __slots__ = ('times', )
+
+    def __init__(self):
+        self.times = array.array('d')
+
+    def add(self, req_time):
+        self.times.append(req_time)
+
+    def merge(self, other):
+        self.times.extend(other.times)
+
+    @property
+    def count(self):
+        return len(self.times)
+
+    @property
+    def time_sum(self):
+        return sum(self.times)
+
+    @property
+    def time_max(self):
+        return max(self.times)
+
+    def quantiles(self, qs):
+        times = sorted(self.times)
+        return [times[quantile_index(len(times), q)] for q in qs]
+
+    def median(self):
+        return self.quantiles((0.5, ))[0]
+
+
+class ApproxStat(object):
+    # Running count/sum/max plus a log-bucketed histogram (relative error
+    # ACCURACY), so memory per url is bounded by the range of request times.
+    __slots__ = ('count', 'partials', 'time_max', 'buckets')
+
+    ACCURACY = 0.01
+    GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self):
+        self.count = 0
+        self.partials = []
+        self.time_max = 0.0
+        self.buckets = {}
+
+    def add(self, req_time):
+        self.count += 1
+        msum_add(self.partials, req_time)
+        if req_time > self.time_max:
+            self.time_max = req_time
+        key = int(math.ceil(math.log(req_time) / self.LOG_GAMMA)) if req_time > 0 else None
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        for p in other.partials:
+            msum_add(self.partials, p)
+        self.time_max = max(self.time_max, other.time_max)
+        for key, n in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + n
+
+    def subtract(self, other):
+        # Takes back times merged in from other. Partials stay exact, but
+        # time_max can't be restored from this stat alone and is left as is.
+        self.count -= other.count
+        for p in other.partials:
+            msum_add(self.partials, -p)
+        for key, n in other.buckets.items():
+            left = self.buckets[key] - n
+            if left:
+                self.buckets[key] = left
+            else:
+                del self.buckets[key]
+
+    @property
+    def time_sum(self):
+        return math.fsum(self.partials)
+
+    def bucket_value(self, key):
+        if key is None:
+            return 0.0
+        return min(2 * self.GAMMA ** key / (self.GAMMA + 1), self.time_max)
+
+    def quantiles(self, qs):
+        targets = sorted((quantile_index(self.count, q), i) for i, q in enumerate(qs))
+        result = [0.0] * len(qs)
+        pos = 0
+        # None bucket holds zero times and goes first
+        for key in sorted(self.buckets, key=lambda k: (k is not None, k)):
+            pos += self.buckets[key]
+            while targets and targets[0][0] < pos:
+                result[targets.pop(0)[1]] = self.bucket_value(key)
+            if not targets:
+                break
+        return result
+
+    def median(self):
+        return self.quantiles((0.5, ))[0]
+
+
+STAT_TYPES = {
+    'exact': ExactStat,
+    'approx': ApproxStat,
+}
+
+
+def get_totals(data):
+    count_all = sum(stat.count for stat in data.values())
+    time_all = math.fsum(stat.time_sum for stat in data.values())
+    return count_all, time_all
+
+
+def parse_line_regex(line):
+    match = RE_PARSE_LINE.search(line)
+    if match is None:
+        return None
+    return match.group('request', 'request_time')
+
+
+def parse_line(line):
+    # A well-formed ui_short line has exactly UI_SHORT_QUOTES quotes: the
+    # request is then the first quoted field and request_time the last token,
+    # so the full regex is only needed for everything else.
+    if line.count(b'"') == UI_SHORT_QUOTES:
+        start = line.index(b'"') + 1
+        request = line[start:line.index(b'"', start)]
+        req_time = line.rsplit(None, 1)[-1]
+    else:
+        rec = parse_line_regex(line)
+        if rec is None:
+            return None
+        request, req_time = rec
+    req_split = request.split()
+    url = req_split[1] if len(req_split) == 3 else request
+    try:
+        return url, float(req_time)
+    except ValueError:
+        return None
+
+
+def compile_log_format(log_format):
+    # Turns an nginx log_format string into a regex that captures only the
+    # url source (the first of URL_VARIABLES present) and $request_time. Each
+    # variable matches up to the character following it in the format, so
+    # nothing backtracks; whitespace matches any run of whitespace. A variable
+    # right before another one takes the whole run unless ADJACENT_VALUES
+    # knows where it ends, as in $uri$is_args$args or $request_time$pipe.
+    log_format = log_format.strip()
+    names = RE_FORMAT_VARIABLE.findall(log_format)
+    url_names = [n for n in URL_VARIABLES if n in names]
+    if not url_names or 'request_time' not in names:
+        raise ValueError('log_format needs $request_time and one of %s' % ', '.join('$' + n for n in URL_VARIABLES))
+    wanted = {url_names[0]: 'url', 'request_time': 'request_time'}
+    parts = RE_FORMAT_VARIABLE.split(log_format)
+    pattern = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            pattern.append(r'\s+'.join(re.escape(p) for p in re.split(r'\s+', part)))
+            continue
+        follow = parts[i + 1][:1]
+        if follow and not follow.isspace():
+            value = r'[^%s]*' % re.escape(follow)
+        elif not follow and i + 2 < len(parts):
+            value = ADJACENT_VALUES.get(part, r'\S*')
+        else:
+            value = r'\S*'
+        if part in wanted:
+            value = '(?P<%s>%s)' % (wanted.pop(part), value)
+        pattern.append(value)
+    return ''.join(pattern), url_names[0] == 'request'
+
+
+def compile_line_parser(log_format):
+    pattern, url_is_request = compile_log_format(log_format)
+    match = re.compile(to_bytes(pattern)).match
+
+    def parse(line):
+        m = match(line)
+        if m is None:
+            return None
+        url, req_time = m.group('url', 'request_time')
+        if url_is_request:
+            req_split = url.split()
+            if len(req_split) == 3:
+                url = req_split[1]
+        try:
+            return url, float(req_time)
+        except ValueError:
+            return None
+
+    return parse
+
+
+LINE_PARSERS = {}
+
+
+def get_line_parser(log_format=None):
+    # ui_short keeps its hand-written tokenizer; other formats are compiled
+    # once per process.
+    if not log_format or log_format == UI_SHORT_FORMAT:
+        return parse_line
+    parser = LINE_PARSERS.get(log_format)
+    if parser is None:
+        parser = LINE_PARSERS[log_format] = compile_line_parser(log_format)
+    return parser
+
+
+def get_url_rules(config):
+    rules = []
+    if config.get('URL_STRIP_QUERY'):
+        rules.append(URL_QUERY_RULE)
+    if config.get('URL_COLLAPSE_IDS'):
+        rules.extend(URL_ID_RULES)
+    rules.extend(tuple(r) for r in config.get('URL_RULES', ()))
+    return tuple(rules)
+
+
+def to_bytes(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+
+class UrlNormalizer(object):
+    # Applies (pattern, replacement) rules to urls in order. Results are
+    # cached per raw url, up to cache_size entries, so the rules run once per
+    # distinct url rather than per line. get_url_normalizer keeps one per
+    # rules in each process, so the cache lasts for a whole log across the
+    # ranges and gzip blocks a worker parses.
+    def __init__(self, rules, cache_size=URL_CACHE_SIZE):
+        # urls are bytes, so are the rules
+        self.rules = [(re.compile(to_bytes(pattern)), to_bytes(repl)) for pattern, repl in rules]
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def normalize(self, raw_url):
+        url = self.cache.get(raw_url)
+        if url is None:
+            url = raw_url
+            for pattern, repl in self.rules:
+                url = pattern.sub(repl, url)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[raw_url] = url
+        return url
+
+
+URL_NORMALIZERS = {}
+
+
+def get_url_normalizer(url_rules):
+    # None when there are no rules and urls are used as they are
+    if not url_rules:
+        return None
+    normalizer = URL_NORMALIZERS.get(url_rules)
+    if normalizer is None:
+        normalizer = URL_NORMALIZERS[url_rules] = UrlNormalizer(url_rules)
+    return normalizer
+
+
+def aggregate(records, stat_type, normalizer=None):
+    # Folds (url, request_time) records, None for unparsed lines, into
+    # per-url stats keyed by raw url, or by normalized url with a normalizer.
+    normalize = normalizer.normalize if normalizer is not None else None
     result = {}
-    count_all = time_all = 0
+    for rec in records:
+        if rec is None:
+            continue
+        url, req_time = rec
+        if normalize is not None:
+            url = normalize(url)
+        stat = result.get(url)
+        if stat is None:
+            stat = result[url] = stat_type()
+        stat.add(req_time)
+    return result
+
+
+def parse_lines(lines, stat_type=ExactStat, normalizer=None, parse=parse_line):
+    return aggregate((parse(line) for line in lines), stat_type, normalizer)
+
+
+def parse_file(file_name, stat_type=ExactStat):
     opener = gzip.open if file_name.endswith('.gz') else open
-    for e, line in enumerate(opener(file_name), 1):
-        rec = RE_PARSE_LINE.search(line).groupdict()
-        req_split = rec['request'].split()
-        if len(req_split) == 3:
-            url = rec['request'].split()[1]
+    with opener(file_name) as f:
+        result = parse_lines(f, stat_type)
+    count_all, time_all = get_totals(result)
+    return result, count_all, time_all
+
+
+def merge_results(result, partial):
+    for url, stat in partial.items():
+        current = result.get(url)
+        if current is None:
+            result[url] = stat
         else:
-            url = rec['request']
-        req_time = float(rec['request_time'])
-        result.setdefault(url, []).append(req_time)
-        count_all += 1
-        time_all += req_time
+            current.merge(stat)
+    return result
+
+
+def iter_blocks(f, block_size, limit=None):
+    # Yields newline-aligned blocks of roughly block_size bytes read from f,
+    # stopping after limit bytes if given.
+    tail = b''
+    while limit is None or limit > 0:
+        data = f.read(block_size if limit is None else min(block_size, limit))
+        if not data:
+            break
+        if limit is not None:
+            limit -= len(data)
+        data = tail + data
+        cut = data.rfind(b'\n') + 1
+        tail = data[cut:]
+        if cut:
+            yield data[:cut]
+    if tail:
+        yield tail
+
+
+def iter_gzip_blocks(file_name, block_size, queue_size=GZIP_QUEUE_SIZE):
+    # Decompression runs in its own thread (zlib releases the GIL) and hands
+    # newline-aligned blocks over a bounded queue, so it overlaps with parsing
+    # without buffering the whole file.
+    blocks = queue.Queue(queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # the consumer may stop early and never take another block
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=GZIP_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            with gzip.open(file_name) as f:
+                for block in iter_blocks(f, block_size):
+                    if not put(block):
+                        return
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is done:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        producer.join()
+
+
+def split_block(block):
+    lines = block.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def split_file(file_name, parts, start=0, end=None):
+    if end is None:
+        end = os.path.getsize(file_name)
+    offsets = [start]
+    with open(file_name, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(start + (end - start) * i // parts)
+            f.readline()
+            offsets.append(min(max(f.tell(), offsets[-1]), end))
+    offsets.append(end)
+    return [(a, b) for a, b in zip(offsets, offsets[1:]) if b > a]
+
+
+def parse_range(file_name, start, end, stat_type, block_size, url_rules=(), log_format=None):
+    result = {}
+    normalizer = get_url_normalizer(url_rules)
+    parse = get_line_parser(log_format)
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        for block in iter_blocks(f, block_size, end - start):
+            merge_results(result, parse_lines(split_block(block), stat_type, normalizer, parse))
+    return result
+
+
+def iter_mmap_records(m, start, end, parse=parse_line):
+    # Walks the mapped file with find and slices out each line for the parser.
+    # Lines are copied whole even for ui_short: parse_line needs the quote
+    # count of the line, which find alone can't get cheaply, and a truncated
+    # line can't be told apart from a well-formed one without it.
+    find = m.find
+    pos = start
+    while pos < end:
+        eol = find(b'\n', pos, end)
+        if eol < 0:
+            eol = end
+        yield parse(m[pos:eol])
+        pos = eol + 1
+
+
+def parse_mmap_range(file_name, start, end, stat_type, url_rules=(), log_format=None):
+    with open(file_name, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        records = iter_mmap_records(m, start, end, get_line_parser(log_format))
+        return aggregate(records, stat_type, get_url_normalizer(url_rules))
+    finally:
+        m.close()
+
+
+def parse_block(block, stat_type, url_rules=(), log_format=None):
+    return parse_lines(split_block(block), stat_type, get_url_normalizer(url_rules), get_line_parser(log_format))
+
+
+def run_task(task):
+    return task[0](*task[1:])
+
+
+def iter_tasks(file_names, stat_type, workers, block_size, start=0, end=None, use_mmap=False, url_rules=(),
+               log_format=None):
+    # Plain logs are cut into newline-aligned byte ranges every worker reads
+    # (or maps) on its own; gzip can't be seeked, so it is decompressed here
+    # and the blocks are shipped to the pool for parsing. start/end limit the
+    # range parsed from plain logs.
+    for file_name in file_names:
+        if file_name.endswith('.gz'):
+            for block in iter_gzip_blocks(file_name, block_size):
+                yield (parse_block, block, stat_type, url_rules, log_format)
+        else:
+            for a, b in split_file(file_name, workers * 4 if workers > 1 else 1, start, end):
+                if use_mmap:
+                    yield (parse_mmap_range, file_name, a, b, stat_type, url_rules, log_format)
+                else:
+                    yield (parse_range, file_name, a, b, stat_type, block_size, url_rules, log_format)
+
+
+def parse_files(file_names, stat_type=ExactStat, workers=1, block_size=None, start=0, end=None, use_mmap=False,
+                url_rules=(), log_format=None):
+    result = {}
+    tasks = iter_tasks(file_names, stat_type, workers, block_size or config['BLOCK_SIZE'], start, end, use_mmap,
+                       url_rules, log_format)
+    if workers <= 1:
+        for task in tasks:
+            merge_results(result, run_task(task))
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            # batches keep the decompressed gzip blocks in flight bounded;
+            # imap keeps file order, so exact times are merged in log order
+            while True:
+                batch = list(itertools.islice(tasks, workers * 2))
+                if not batch:
+                    break
+                for partial in pool.imap(run_task, batch):
+                    merge_results(result, partial)
+        finally:
+            pool.close()
+            pool.join()
+    count_all, time_all = get_totals(result)
     return result, count_all, time_all
 
 
-def calc_result(data, count_all, time_all, report_size):
-    CALC_VALUES = {
-        'count': len,
-        'count_perc': lambda v: round((100 * float(len(v))) / count_all, 3),
-        'time_avg': lambda v: round(sum(v) / len(v), 3),
-        'time_max': max,
-        'time_med': lambda v: round(sorted(v)[len(v) // 2], 3),
-        'time_perc': lambda v: round((100 * sum(v)) / time_all, 3),
-        'time_sum': lambda v: round(sum(v), 3)
-    }
+def calc_stats(items, qs):
+    for url, stat in items:
+        yield url, stat.count, stat.time_sum, stat.time_max, stat.quantiles(qs)
+
+
+def calc_stats_numpy(items, qs):
+    # All times go into one float64 array grouped by url id, so max is a
+    # single reduceat pass; quantiles are taken per url with numpy.partition
+    # instead of a full sort. Sums stay sequential (numpy adds pairwise) to
+    # keep the report identical to calc_stats.
+    if not items:
+        return
+    counts = numpy.fromiter((stat.count for _, stat in items), dtype=numpy.int64, count=len(items))
+    times = numpy.concatenate([numpy.asarray(stat.times, dtype=numpy.float64) for _, stat in items])
+    offsets = numpy.zeros(len(items), dtype=numpy.int64)
+    numpy.cumsum(counts[:-1], out=offsets[1:])
+    maxes = numpy.maximum.reduceat(times, offsets)
+    for i, (url, stat) in enumerate(items):
+        count, offset = int(counts[i]), offsets[i]
+        kth = [quantile_index(count, q) for q in qs]
+        values = numpy.partition(times[offset:offset + count], kth)[kth]
+        yield url, count, sum(stat.times), float(maxes[i]), [float(v) for v in values]
+
+
+def calc_result(data, count_all, time_all, report_size, percentiles=(), use_numpy=False):
+    def rank(item):
+        # the (time_perc, time_sum) report order depends on time_sum only;
+        # the url breaks ties, so the report doesn't follow the dict order
+        return round((100 * item[1]) / time_all, 3), round(item[1], 3), item[0]
+
+    # Only the report_size urls with the largest time_sum survive, so the
+    # per-url statistics are computed for them alone. nlargest keeps the
+    # order sorted(..., reverse=True)[:report_size] would give.
+    top = heapq.nlargest(report_size, ((url, stat.time_sum) for url, stat in data.items()), key=rank)
+    items = [(url, data[url]) for url, _ in top]
+    qs = (0.5, ) + tuple(p / 100.0 for p in percentiles)
+    if use_numpy and numpy is not None and all(isinstance(s, ExactStat) for _, s in items):
+        stats = calc_stats_numpy(items, qs)
+    else:
+        stats = calc_stats(items, qs)
 
     result = []
-    for url, times in data.items():
-        rec = {'url': url}
-        for field, func in CALC_VALUES.items():
-            rec[field] = func(times)
+    for url, count, time_sum, time_max, values in stats:
+        rec = {
+            'url': url,
+            'count': count,
+            'count_perc': round((100 * float(count)) / count_all, 3),
+            'time_avg': round(time_sum / count, 3),
+            'time_max': time_max,
+            'time_med': round(values[0], 3),
+            'time_perc': round((100 * time_sum) / time_all, 3),
+            'time_sum': round(time_sum, 3),
+        }
+        for p, v in zip(percentiles, values[1:]):
+            rec['time_p%s' % p] = round(v, 3)
         result.append(rec)
-    return sorted(result, reverse=True, key=lambda v: (v['time_perc'], v['time_sum']))[:report_size]
+    return result
+
+
+TEMPLATE_PARTS = {}
 
 
-def render_result(data, report_file_name):
-    template = open(REPORT_TEMPLATE).read()
-    open(report_file_name, 'w').write(template.replace('$table_json', json.dumps(data)))
+def get_template_parts(template_name):
+    parts = TEMPLATE_PARTS.get(template_name)
+    if parts is None:
+        with open(template_name) as f:
+            parts = TEMPLATE_PARTS[template_name] = f.read().split('$table_json')
+    return parts
+
+
+def write_table_json(f, data):
+    # same text as json.dumps(data), one row at a time
+    f.write('[')
+    for i, row in enumerate(data):
+        if i:
+            f.write(', ')
+        f.write(json.dumps(row))
+    f.write(']')
+
+
+def render_result(data, report_file_name, template_name=REPORT_TEMPLATE):
+    # The report is written to a temporary file next to it and renamed into
+    # place, so an existing report is always a complete one.
+    parts = get_template_parts(template_name)
+    report_dir = os.path.dirname(report_file_name) or '.'
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    fd, tmp_name = tempfile.mkstemp(prefix='.report-', suffix='.tmp', dir=report_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(parts[0])
+            for part in parts[1:]:
+                write_table_json(f, data)
+                f.write(part)
+        os.chmod(tmp_name, 0o644)
+        os.rename(tmp_name, report_file_name)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+
+class LogReader(object):
+    # newline-aligned blocks appended to an open log, the unfinished last
+    # line is kept for the next read
+    def __init__(self, f):
+        self.f = f
+        self.tail = b''
+
+    def iter_blocks(self, block_size):
+        while True:
+            data = self.f.read(block_size)
+            if not data:
+                return
+            data = self.tail + data
+            cut = data.rfind(b'\n') + 1
+            self.tail = data[cut:]
+            if cut:
+                yield data[:cut]
+
+    def rewind(self):
+        self.f.seek(0)
+        self.tail = b''
+
+    def close(self):
+        self.f.close()
+
+
+class LogFollower(object):
+    # Reads lines appended to a live log like tail -F: a rotated log (new
+    # inode under the same name) is reopened from its start, a truncated one
+    # is reread from offset 0. The writer keeps appending to the rotated file
+    # until it reopens its log, so that one is read on as well and only closed
+    # once it stayed idle for a poll while the new file has data.
+    def __init__(self, file_name, block_size, from_start=False):
+        self.file_name = file_name
+        self.block_size = block_size
+        self.from_start = from_start
+        self.reader = None
+        self.rotated = None
+        self.inode = None
+
+    def open(self, from_start):
+        try:
+            f = io.open(self.file_name, 'rb')
+        except IOError:
+            return None
+        if not from_start:
+            f.seek(0, io.SEEK_END)
+        self.inode = os.fstat(f.fileno()).st_ino
+        return LogReader(f)
+
+    def iter_blocks(self):
+        # newline-aligned blocks appended since the previous call
+        if self.reader is None:
+            self.reader = self.open(self.from_start)
+            if self.reader is None:
+                return
+        if self.rotated is not None:
+            idle = True
+            for block in self.rotated.iter_blocks(self.block_size):
+                idle = False
+                yield block
+            if idle and os.fstat(self.reader.f.fileno()).st_size > 0:
+                self.rotated.close()
+                self.rotated = None
+        while True:
+            for block in self.reader.iter_blocks(self.block_size):
+                yield block
+            try:
+                st = os.stat(self.file_name)
+            except OSError:
+                return
+            if st.st_ino != self.inode:
+                reader = self.open(True)
+                if reader is None:
+                    return
+                if self.rotated is not None:
+                    self.rotated.close()
+                self.rotated, self.reader = self.reader, reader
+            elif st.st_size < self.reader.f.tell():
+                self.reader.rewind()
+            else:
+                return
+
+
+class WindowStats(object):
+    # Per-url stats of the last `window` seconds kept in `slots` slots, plus
+    # their running total: data is merged into the newest slot and the total,
+    # and a slot falling out of the window is subtracted from the total. A
+    # refresh then depends on the number of urls, not of lines; only
+    # ApproxStat can be subtracted, so the window is always approximate.
+    def __init__(self, window, slots):
+        self.slot_seconds = float(window) / slots
+        self.slots_count = slots
+        self.slots = deque()
+        self.total = {}
+
+    def add(self, data, now):
+        slot_id = int(now // self.slot_seconds)
+        if not self.slots or self.slots[-1][0] != slot_id:
+            self.slots.append((slot_id, {}))
+        for url, stat in data.items():
+            for stats in (self.slots[-1][1], self.total):
+                current = stats.get(url)
+                if current is None:
+                    current = stats[url] = ApproxStat()
+                current.merge(stat)
+        self.evict(now)
+
+    def evict(self, now):
+        oldest = int(now // self.slot_seconds) - self.slots_count + 1
+        while self.slots and self.slots[0][0] < oldest:
+            for url, stat in self.slots.popleft()[1].items():
+                current = self.total[url]
+                if current.count == stat.count:
+                    del self.total[url]
+                    continue
+                current.subtract(stat)
+                if stat.time_max >= current.time_max:
+                    current.time_max = max(s[url].time_max for _, s in self.slots if url in s)
+
+
+def follow(config):
+    # Daemon mode: aggregates lines appended to FOLLOW_LOG over a rolling
+    # FOLLOW_WINDOW and rewrites report-live.html every FOLLOW_REFRESH seconds.
+    # Stats are approximate whatever MEDIAN_MODE says, see WindowStats.
+    follower = LogFollower(os.path.join(config['LOG_DIR'], config['FOLLOW_LOG']), config['BLOCK_SIZE'])
+    window = WindowStats(config['FOLLOW_WINDOW'], config['FOLLOW_SLOTS'])
+    normalizer = get_url_normalizer(get_url_rules(config))
+    parse = get_line_parser(config.get('LOG_FORMAT'))
+    report_name = os.path.join(config['REPORT_DIR'], 'report-live.html')
+    next_refresh = 0
+    while True:
+        for block in follower.iter_blocks():
+            window.add(parse_lines(split_block(block), ApproxStat, normalizer, parse), time.time())
+        now = time.time()
+        if now >= next_refresh:
+            window.evict(now)
+            data = window.total
+            count_all, time_all = get_totals(data)
+            result = calc_result(data, count_all, time_all, config['REPORT_SIZE'],
+                                 config.get('PERCENTILES', ()), config.get('USE_NUMPY', False))
+            render_result(result, report_name)
+            next_refresh = now + config['FOLLOW_REFRESH']
+        time.sleep(config['FOLLOW_POLL'])
 
 
 if __name__ == "__main__":
-    main(config)
+    op = OptionParser()
+    op.add_option("-f", "--follow", action="store_true", default=False)
+    (opts, args) = op.parse_args()
+    if opts.follow:
+        try:
+            follow(config)
+        except KeyboardInterrupt:
+            pass
+    else:
+        main(config)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Throughput of log_analyzer stages:
+#   python log_benchmark.py [options] [log_file]
+# Without a log file one is generated by log_generator into a temporary
+# directory (see --lines/--urls/--zipf/--malformed/--gzip). Reports seconds
+# per stage, parse lines/sec and peak RSS of this process and its workers.
+# --tokenizer compares the old groupdict tokenizer with parse_line instead;
+# without a file it runs on a built-in ui_short sample.
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import log_analyzer
+import log_generator
+
+SAMPLE_LINES = (
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" '
+    b'"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+    b'"dc7161be3" 0.390\n',
+    b'1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 '
+    b'HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" "1498697422-32900793-4708-9752770" "-" 0.133\n',
+    b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/group/1769230/banners HTTP/1.1" 200 1020 "-" '
+    b'"Configovod" "-" "1498697422-2118016444-4708-9752747" "712e90144abee9" 0.628\n',
+    b'1.194.135.240 -  - [29/Jun/2017:03:52:04 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n',
+)
+SAMPLE_REPEAT = 50000
+REPEAT = 3
+MINIMAL_TEMPLATE = '<html><body><script>var table = $table_json;</script></body></html>\n'
+
+
+def parse_line_groupdict(line):
+    # the tokenizer log_analyzer used before parse_line, with lines it can't
+    # parse skipped as parse_line does
+    match = log_analyzer.RE_PARSE_LINE.search(line)
+    if match is None:
+        return None
+    rec = match.groupdict()
+    req_split = rec['request'].split()
+    url = req_split[1] if len(req_split) == 3 else rec['request']
+    try:
+        return url, float(rec['request_time'])
+    except ValueError:
+        return None
+
+
+def lines_per_sec(func, lines):
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        for line in lines:
+            func(line)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def bench_tokenizer(file_name):
+    if file_name:
+        with open(file_name, 'rb') as f:
+            lines = f.readlines()
+    else:
+        lines = list(SAMPLE_LINES) * SAMPLE_REPEAT
+    for name, func in (('regex groupdict', parse_line_groupdict), ('parse_line', log_analyzer.parse_line)):
+        unparsed = sum(1 for line in lines if func(line) is None)
+        print('%-16s %12.0f lines/sec, %d unparsed' % (name, lines_per_sec(func, lines), unparsed))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024.0, children / 1024.0
+
+
+def print_timing(name, elapsed):
+    print('%-14s %8.3f s' % (name, elapsed))
+    sys.stdout.flush()
+
+
+def bench_stages(file_name, opts):
+    # each stage's time is printed as soon as it is over
+    stat_type = log_analyzer.STAT_TYPES[opts.mode]
+    print('%s: %d bytes' % (file_name, os.path.getsize(file_name)))
+
+    start = time.time()
+    data, count_all, time_all = log_analyzer.parse_files([file_name], stat_type, opts.workers,
+                                                         use_mmap=opts.mmap)
+    parse_elapsed = time.time() - start
+    print_timing('parse_files', parse_elapsed)
+    print('%-14s %8.0f lines/sec, %d parsed lines, %d urls' % ('parse', count_all / parse_elapsed, count_all,
+                                                               len(data)))
+
+    start = time.time()
+    result = log_analyzer.calc_result(data, count_all, time_all, opts.report_size,
+                                      log_analyzer.config['PERCENTILES'], opts.numpy)
+    print_timing('calc_result', time.time() - start)
+
+    report_dir = tempfile.mkdtemp()
+    try:
+        template = opts.template
+        if not os.path.exists(template):
+            print('%s not found, rendering with a minimal template' % template)
+            template = os.path.join(report_dir, 'template.html')
+            with open(template, 'w') as f:
+                f.write(MINIMAL_TEMPLATE)
+        start = time.time()
+        log_analyzer.render_result(result, os.path.join(report_dir, 'report.html'), template)
+        print_timing('render_result', time.time() - start)
+    finally:
+        shutil.rmtree(report_dir)
+
+    print('%-14s %8.1f MB (workers %.1f MB)' % (('peak rss', ) + peak_rss_mb()))
+
+
+def main(argv):
+    op = OptionParser(usage='%prog [options] [log_file]')
+    op.add_option("--tokenizer", action="store_true", default=False)
+    op.add_option("-n", "--lines", action="store", type=int, default=1000000)
+    op.add_option("-u", "--urls", action="store", type=int, default=10000)
+    op.add_option("-z", "--zipf", action="store", type=float, default=1.1)
+    op.add_option("-m", "--malformed", action="store", type=float, default=0.001)
+    op.add_option("--gzip", action="store_true", default=False)
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("--mode", action="store", choices=sorted(log_analyzer.STAT_TYPES), default="exact")
+    op.add_option("--no-mmap", action="store_false", dest="mmap", default=True)
+    op.add_option("--no-numpy", action="store_false", dest="numpy", default=True)
+    op.add_option("--report-size", action="store", type=int, default=log_analyzer.config['REPORT_SIZE'])
+    op.add_option("--template", action="store", default=log_analyzer.REPORT_TEMPLATE)
+    (opts, args) = op.parse_args(argv[1:])
+    file_name = args[0] if args else None
+
+    if opts.tokenizer:
+        bench_tokenizer(file_name)
+        return
+    if file_name:
+        bench_stages(file_name, opts)
+        return
+    log_dir = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(log_dir, 'nginx-access-ui.log-20170630' + ('.gz' if opts.gzip else ''))
+        start = time.time()
+        log_generator.generate(file_name, opts.lines, opts.urls, opts.zipf, opts.malformed, seed=1)
+        print('generated in %.3f s' % (time.time() - start))
+        bench_stages(file_name, opts)
+    finally:
+        shutil.rmtree(log_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synthetic nginx ui_short logs for log_analyzer benchmarks:
+#   python log_generator.py -n 1000000 -u 50000 --gzip -o ./log/nginx-access-ui.log-20170630.gz
+# Url popularity follows a Zipf law, request times are lognormal around a
+# per-url base latency, and a share of lines is malformed.
+
+import bisect
+import gzip
+import random
+import sys
+from optparse import OptionParser
+
+LINE_FORMAT = ('%(ip)s %(user)s  - [%(time)s +0300] "%(method)s %(url)s HTTP/1.1" %(status)s %(size)d "-" '
+               '"%(agent)s" "-" "%(request_id)s" "%(rb_user)s" %(request_time).3f\n')
+URL_PATTERNS = (
+    '/api/v2/banner/%d',
+    '/api/v2/group/%d/banners',
+    '/api/v2/group/%d/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB%d',
+    '/api/v2/internal/banner/%d/info',
+    '/api/v2/slot/%d/groups',
+    '/export/appinstall_raw/2017-06-%02d/',
+)
+AGENTS = (
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Python-urllib/2.7',
+    'Configovod',
+    'python-requests/2.13.0',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+)
+MALFORMED_LINES = (
+    '1.194.135.240 -  - [29/Jun/2017:03:52:04 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n',
+    '1.138.198.128 -  - [29/Jun/2017:03:52:04 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 "-" "-"\n',
+    '\x16\x03\x01\x00\xa2\x01\x00\x00\x9e\x03\x01\n',
+    '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/7 HTTP/1.1" 200 12 "-" "-" "-" "-" "-" -\n',
+)
+
+
+def make_urls(count, rnd):
+    return [URL_PATTERNS[i % len(URL_PATTERNS)] % (i // len(URL_PATTERNS) + 1) for i in rnd.sample(range(count), count)]
+
+
+def make_popularity(count, zipf):
+    # cumulative Zipf weights, rank k is picked with probability ~ 1 / k ** zipf
+    total, cumulative = 0.0, []
+    for k in range(1, count + 1):
+        total += 1.0 / k ** zipf
+        cumulative.append(total)
+    return cumulative
+
+
+def iter_lines(lines, urls=10000, zipf=1.1, malformed=0.001, seed=None):
+    rnd = random.Random(seed)
+    url_list = make_urls(urls, rnd)
+    latency = [rnd.lognormvariate(-1.5, 1.0) for _ in url_list]
+    popularity = make_popularity(urls, zipf)
+    total = popularity[-1]
+    for n in range(lines):
+        second = n * 86400 // lines
+        if rnd.random() < malformed:
+            yield rnd.choice(MALFORMED_LINES)
+            continue
+        i = min(bisect.bisect(popularity, rnd.random() * total), urls - 1)
+        yield LINE_FORMAT % {
+            'ip': '1.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+            'user': rnd.choice(('-', '3b81f63526fa8', 'f032b48fb33e1e692')),
+            'time': '29/Jun/2017:%02d:%02d:%02d' % (second // 3600, second // 60 % 60, second % 60),
+            'method': 'POST' if rnd.random() < 0.1 else 'GET',
+            'url': url_list[i],
+            'status': 200 if rnd.random() < 0.98 else rnd.choice((301, 404, 500)),
+            'size': rnd.randint(12, 100000),
+            'agent': rnd.choice(AGENTS),
+            'request_id': '1498697422-%d-4708-%d' % (rnd.randint(0, 2 ** 32), 9752759 + n),
+            'rb_user': '%x' % rnd.randint(0, 2 ** 36),
+            'request_time': latency[i] * rnd.lognormvariate(0, 0.5),
+        }
+
+
+def generate(file_name, lines, urls=10000, zipf=1.1, malformed=0.001, seed=None):
+    opener = gzip.open if file_name.endswith('.gz') else open
+    f = opener(file_name, 'wb')
+    try:
+        for line in iter_lines(lines, urls, zipf, malformed, seed):
+            f.write(line)
+    finally:
+        f.close()
+
+
+def main(argv):
+    op = OptionParser(usage='%prog [options]')
+    op.add_option("-o", "--output", action="store", default="nginx-access-ui.log-20170630")
+    op.add_option("-n", "--lines", action="store", type=int, default=1000000)
+    op.add_option("-u", "--urls", action="store", type=int, default=10000)
+    op.add_option("-z", "--zipf", action="store", type=float, default=1.1)
+    op.add_option("-m", "--malformed", action="store", type=float, default=0.001)
+    op.add_option("-s", "--seed", action="store", type=int, default=None)
+    op.add_option("--gzip", action="store_true", default=False)
+    (opts, args) = op.parse_args(argv[1:])
+    file_name = opts.output
+    if opts.gzip and not file_name.endswith('.gz'):
+        file_name += '.gz'
+    generate(file_name, opts.lines, opts.urls, opts.zipf, opts.malformed, opts.seed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
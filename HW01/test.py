@@ -0,0 +1,362 @@
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import log_analyzer as la
+import log_generator
+
+BLOCK_SIZE = 4096
+TRUNCATED_LINES = (
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 927\n',
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" 0.3\n',
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1\n',
+    b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 927 "-" "-" "-" "-" "-" \n',
+)
+
+
+class TestParsePaths(unittest.TestCase):
+    # Every way of reading a log has to skip the same malformed and
+    # truncated lines and give the same aggregates.
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        rnd = random.Random(0)
+        lines = list(log_generator.iter_lines(5000, urls=100, malformed=0.02, seed=0))
+        cls.well_formed = sum(1 for line in lines if line not in log_generator.MALFORMED_LINES[1:])
+        for line in TRUNCATED_LINES:
+            for _ in range(20):
+                lines.insert(rnd.randrange(len(lines)), line)
+        data = b''.join(line if isinstance(line, bytes) else line.encode('latin-1') for line in lines)
+        cls.log_name = os.path.join(cls.dir, 'nginx-access-ui.log-20170630')
+        with open(cls.log_name, 'wb') as f:
+            f.write(data)
+        cls.gz_name = os.path.join(cls.dir, 'nginx-access-ui.log-20170629.gz')
+        with gzip.open(cls.gz_name, 'wb') as f:
+            f.write(data)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def get_times(self, data):
+        return dict((url, list(stat.times)) for url, stat in data.items())
+
+    def parse(self, file_name, **kwargs):
+        return self.get_times(la.parse_files([file_name], block_size=BLOCK_SIZE, **kwargs)[0])
+
+    def test_truncated_line(self):
+        file_name = os.path.join(self.dir, 'truncated.log')
+        with open(file_name, 'wb') as f:
+            f.write(TRUNCATED_LINES[0] + b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /b HTTP/1.1" 200 927 '
+                    b'"-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.500\n')
+        for use_mmap in (False, True):
+            self.assertEqual(self.parse(file_name, use_mmap=use_mmap), {b'/b': [0.5]})
+
+    def test_same_aggregates(self):
+        expected = self.parse(self.log_name)
+        self.assertEqual(sum(len(times) for times in expected.values()), self.well_formed)
+        self.assertNotIn(b'/a', expected)
+        for workers in (1, 2):
+            for use_mmap in (False, True):
+                self.assertEqual(self.parse(self.log_name, workers=workers, use_mmap=use_mmap), expected)
+            self.assertEqual(self.parse(self.gz_name, workers=workers), expected)
+
+    def test_url_rules(self):
+        rules = la.get_url_rules({'URL_STRIP_QUERY': True, 'URL_COLLAPSE_IDS': True})
+        normalizer = la.UrlNormalizer(rules)
+        expected = {}
+        for url, times in self.parse(self.log_name).items():
+            expected.setdefault(normalizer.normalize(url), []).extend(times)
+        self.assertLess(len(expected), len(self.parse(self.log_name)))
+        for workers in (1, 2):
+            for use_mmap in (False, True):
+                data = self.parse(self.log_name, workers=workers, use_mmap=use_mmap, url_rules=rules)
+                self.assertEqual(dict((url, sorted(times)) for url, times in data.items()),
+                                 dict((url, sorted(times)) for url, times in expected.items()))
+            data = self.parse(self.gz_name, workers=workers, url_rules=rules)
+            self.assertEqual(sorted(data), sorted(expected))
+        cache_name = self.log_name + '.rules.cols'
+        la.build_column_cache(self.log_name, cache_name, BLOCK_SIZE)
+        data = self.get_times(la.load_column_cache(cache_name, la.ExactStat, rules))
+        self.assertEqual(dict((url, sorted(times)) for url, times in data.items()),
+                         dict((url, sorted(times)) for url, times in expected.items()))
+        self.assertIs(la.get_url_normalizer(rules), la.get_url_normalizer(rules))
+
+    def test_gzip_consumer_stops_early(self):
+        threads = threading.active_count()
+        blocks = la.iter_gzip_blocks(self.gz_name, BLOCK_SIZE, queue_size=1)
+        next(blocks)
+        blocks.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_column_cache(self):
+        expected = self.parse(self.log_name)
+        for file_name in (self.log_name, self.gz_name):
+            cache_name = file_name + '.cols'
+            la.build_column_cache(file_name, cache_name, BLOCK_SIZE)
+            self.assertEqual(self.get_times(la.load_column_cache(cache_name, la.ExactStat)), expected)
+        cache_name = self.log_name + '.pool.cols'
+        for workers in (1, 2):
+            for use_mmap in (False, True):
+                la.build_column_cache(self.log_name, cache_name, BLOCK_SIZE, workers=workers, use_mmap=use_mmap)
+                self.assertEqual(self.get_times(la.load_column_cache(cache_name, la.ExactStat)), expected)
+
+    def test_empty_column_cache(self):
+        cache_name = os.path.join(self.dir, 'empty.cols')
+        open(cache_name, 'wb').close()
+        self.assertIsNone(la.load_column_cache(cache_name, la.ExactStat))
+
+    def test_old_column_caches_removed(self):
+        cache_dir = os.path.join(self.dir, 'cache')
+        file_name = os.path.join(self.dir, 'growing.log')
+        config = dict(la.config, CACHE_DIR=cache_dir, COLUMN_CACHE=True, BLOCK_SIZE=BLOCK_SIZE)
+        with open(self.log_name, 'rb') as f:
+            lines = f.readlines()
+        for size in (1000, 2000):
+            with open(file_name, 'wb') as f:
+                f.write(b''.join(lines[:size]))
+            data = la.parse_log(file_name, la.ExactStat, (), config)
+            self.assertEqual(self.get_times(data), self.parse(file_name))
+            self.assertEqual(os.listdir(cache_dir), [os.path.basename(la.get_cache_name(cache_dir, file_name))])
+
+
+class TestResume(unittest.TestCase):
+    # A resumed plain log has to give what one parse of it gives now.
+    log_name = 'nginx-access-ui.log-20170630'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        with open(la.REPORT_TEMPLATE, 'w') as f:
+            f.write('$table_json\n')
+        os.makedirs('log')
+        os.makedirs('state')
+        self.lines = [line if isinstance(line, bytes) else line.encode('latin-1')
+                      for line in log_generator.iter_lines(3000, urls=100, malformed=0.02, seed=2)]
+        self.config = dict(la.config, LOG_DIR='log', STATE_DIR='state', REPORT_DIR='reports', BLOCK_SIZE=BLOCK_SIZE)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def write(self, data, mode='wb'):
+        with open(os.path.join('log', self.log_name), mode) as f:
+            f.write(data)
+
+    def load(self, **config):
+        data, changed = la.load_log_data(self.log_name, la.ExactStat, dict(self.config, **config))
+        return dict((url, sorted(stat.times)) for url, stat in data.items()), changed
+
+    def fresh(self, data, **config):
+        file_name = os.path.join(self.dir, 'fresh.log')
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        url_rules = la.get_url_rules(dict(self.config, **config))
+        data = la.parse_files([file_name], la.ExactStat, url_rules=url_rules)[0]
+        return dict((url, sorted(stat.times)) for url, stat in data.items())
+
+    def test_partial_last_line(self):
+        # cut inside request_time, where the partial line still parses
+        head, partial = b''.join(self.lines[:1000]), self.lines[1000][:-3]
+        self.write(head + partial)
+        self.assertEqual(self.load(), (self.fresh(head), True))
+        self.assertEqual(self.load(), (self.fresh(head), False))
+        self.write(self.lines[1000][-3:] + b''.join(self.lines[1001:2000]), 'ab')
+        self.assertEqual(self.load(), (self.fresh(b''.join(self.lines[:2000])), True))
+
+    def test_truncated_below_offset(self):
+        self.write(b''.join(self.lines[:2000]))
+        self.load()
+        self.write(b''.join(self.lines[2000:2500]))
+        self.assertEqual(self.load(), (self.fresh(b''.join(self.lines[2000:2500])), True))
+
+    def test_url_rules_changed(self):
+        data = b''.join(self.lines)
+        self.write(data)
+        self.load()
+        expected = self.fresh(data, URL_COLLAPSE_IDS=True)
+        self.assertLess(len(expected), len(self.fresh(data)))
+        self.assertEqual(self.load(URL_COLLAPSE_IDS=True), (expected, True))
+        self.assertEqual(self.load(URL_COLLAPSE_IDS=True), (expected, False))
+
+    @unittest.skipIf(sys.version_info[0] > 2, 'reports are rendered on Python 2')
+    def test_main_twice(self):
+        report_name = la.get_report_name('reports', [self.log_name])
+        self.write(b''.join(self.lines[:1500]) + self.lines[1500][:-3])
+        la.main(self.config)
+        self.write(self.lines[1500][-3:] + b''.join(self.lines[1501:]), 'ab')
+        la.main(self.config)
+        with open(report_name) as f:
+            resumed = f.read()
+        la.main(dict(self.config, STATE_DIR='fresh_state', REPORT_DIR='fresh_reports'))
+        with open(la.get_report_name('fresh_reports', [self.log_name])) as f:
+            self.assertEqual(resumed, f.read())
+
+
+class TestLogFormat(unittest.TestCase):
+    def test_ui_short(self):
+        # the compiled ui_short format has to agree with parse_line, malformed lines included
+        parse = la.compile_line_parser(la.UI_SHORT_FORMAT)
+        lines = [line if isinstance(line, bytes) else line.encode('latin-1')
+                 for line in log_generator.iter_lines(2000, urls=50, malformed=0.05, seed=1)]
+        lines.extend(TRUNCATED_LINES)
+        self.assertTrue(any(la.parse_line(line) is None for line in lines))
+        for line in lines:
+            self.assertEqual(parse(line), la.parse_line(line))
+
+    def test_url_variables(self):
+        line = b'1.2.3.4 [29/Jun/2017:03:50:22 +0300] "/a/b?x=1" /a/b 0.500\n'
+        parse = la.compile_line_parser('$remote_addr [$time_local] "$request_uri" $uri $request_time')
+        self.assertEqual(parse(line), (b'/a/b?x=1', 0.5))
+        parse = la.compile_line_parser('$remote_addr [$time_local] "$http_referer" $uri $request_time')
+        self.assertEqual(parse(line), (b'/a/b', 0.5))
+
+    def test_adjacent_variables(self):
+        parse = la.compile_line_parser('$a$b "$request" $request_time')
+        self.assertEqual(parse(b'1.2.3.4- "GET /a HTTP/1.1" 0.500\n'), (b'/a', 0.5))
+        parse = la.compile_line_parser('$uri$is_args$args $request_time$pipe')
+        self.assertEqual(parse(b'/a?x=1 0.500p\n'), (b'/a', 0.5))
+        self.assertEqual(parse(b'/a 0.500.\n'), (b'/a', 0.5))
+
+    def test_missing_variables(self):
+        for log_format in ('$remote_addr "$request" $status', '$remote_addr "$http_referer" $request_time'):
+            self.assertRaises(ValueError, la.compile_log_format, log_format)
+
+
+class TestCalcResult(unittest.TestCase):
+    def test_ties_ordered_by_url(self):
+        # the order urls were merged in must not leak into the report
+        urls = [('/%d' % i).encode('ascii') for i in range(20)]
+        reports = []
+        for seed in range(5):
+            random.Random(seed).shuffle(urls)
+            data = la.aggregate(((url, 0.5) for url in urls), la.ExactStat)
+            reports.append([rec['url'] for rec in la.calc_result(data, len(urls), 0.5 * len(urls), 10)])
+        self.assertEqual(reports, [reports[0]] * len(reports))
+
+
+class TestWindowStats(unittest.TestCase):
+    def test_running_total(self):
+        # the total has to match the slots still in the window merged anew
+        rnd = random.Random(0)
+        window = la.WindowStats(60, 6)
+        for now in range(0, 300, 3):
+            urls = (b'/a', b'/b', b'/c', b'/d', b'/e', b'/f')[now // 60:now // 60 + 2]
+            data = la.aggregate(((rnd.choice(urls), round(rnd.expovariate(5), 3))
+                                 for _ in range(20)), la.ApproxStat)
+            window.add(data, now)
+            expected = {}
+            for _, slot in window.slots:
+                for url, stat in slot.items():
+                    expected.setdefault(url, la.ApproxStat()).merge(stat)
+            self.assertEqual(sorted(window.total), sorted(expected))
+            for url, stat in expected.items():
+                total = window.total[url]
+                self.assertEqual((total.count, total.time_sum, total.time_max, total.buckets),
+                                 (stat.count, stat.time_sum, stat.time_max, stat.buckets))
+
+
+class ScandirEntry(object):
+    # a scandir entry that records stat calls
+    def __init__(self, entry, stated):
+        self.entry = entry
+        self.name = entry.name
+        self.stated = stated
+
+    def is_file(self):
+        return self.entry.is_file()
+
+    def stat(self):
+        self.stated.append(self.name)
+        return self.entry.stat()
+
+
+class TestLogFollower(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_name = os.path.join(self.dir, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, follower):
+        return b''.join(follower.iter_blocks())
+
+    def test_rotation(self):
+        f = open(self.log_name, 'wb', 0)
+        follower = la.LogFollower(self.log_name, BLOCK_SIZE, from_start=True)
+        f.write(b'l1\n')
+        self.assertEqual(self.read(follower), b'l1\n')
+        # the writer goes on with the renamed file until it reopens its log
+        os.rename(self.log_name, self.log_name + '.1')
+        new = open(self.log_name, 'wb', 0)
+        self.assertEqual(self.read(follower), b'')
+        f.write(b'l2\n')
+        new.write(b'l3\n')
+        self.assertEqual(self.read(follower), b'l2\nl3\n')
+        f.close()
+        new.write(b'l4\n')
+        self.assertEqual(self.read(follower), b'l4\n')
+        self.assertIsNone(follower.rotated)
+        new.close()
+
+    def test_truncation(self):
+        with open(self.log_name, 'wb') as f:
+            f.write(b'l1\nl2\n')
+        follower = la.LogFollower(self.log_name, BLOCK_SIZE, from_start=True)
+        self.assertEqual(self.read(follower), b'l1\nl2\n')
+        with open(self.log_name, 'wb') as f:
+            f.write(b'l3\n')
+        self.assertEqual(self.read(follower), b'l3\n')
+
+
+class TestLogIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stat = os.stat
+        self.stated = []
+
+        def stat(path, *args, **kwargs):
+            self.stated.append(os.path.basename(path))
+            return self.stat(path, *args, **kwargs)
+
+        os.stat = stat
+        self.scandir = la.scandir
+        if la.scandir is not None:
+            la.scandir = lambda path: [ScandirEntry(entry, self.stated) for entry in self.scandir(path)]
+
+    def tearDown(self):
+        os.stat = self.stat
+        la.scandir = self.scandir
+        shutil.rmtree(self.dir)
+
+    def touch(self, name):
+        open(os.path.join(self.dir, name), 'wb').close()
+
+    def test_known_gz_logs_not_stated(self):
+        for day in range(1, 6):
+            self.touch('nginx-access-ui.log-201706%02d.gz' % day)
+        self.touch('nginx-access-ui.log-20170606')
+        index = la.update_log_index(self.dir)
+        self.assertEqual(len(index['logs']), 6)
+        # a rotation: the plain log is compressed and a new one started
+        os.rename(os.path.join(self.dir, 'nginx-access-ui.log-20170606'),
+                  os.path.join(self.dir, 'nginx-access-ui.log-20170606.gz'))
+        self.touch('nginx-access-ui.log-20170607')
+        os.utime(self.dir, (0, 0))
+        del self.stated[:]
+        index = la.update_log_index(self.dir, index)
+        self.assertEqual(sorted(set(self.stated) - {os.path.basename(self.dir)}),
+                         ['nginx-access-ui.log-20170606.gz', 'nginx-access-ui.log-20170607'])
+        self.assertEqual(sorted(index['logs']), ['nginx-access-ui.log-201706%02d.gz' % day for day in range(1, 7)] +
+                         ['nginx-access-ui.log-20170607'])
+
+
+if __name__ == '__main__':
+    unittest.main()
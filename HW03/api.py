@@ -68,18 +68,48 @@
 # $ curl -X POST  -H "Content-Type: application/json" -d '{"account": "horns&hoofs", "login": "admin", "method": "clients_interests", "token": "d3573aff1555cd67dccf21b95fe8c4dc8732f33fd4e32461b7fe6a71d83c947688515e36774c00fb630b039fe2223c991f045f13f24091386050205c324687a0", "arguments": {"client_ids": [1,2,3,4], "date": "20.07.2017"}}' http://127.0.0.1:8080/method/
 # -> {"code": 200, "response": {"1": ["books", "hi-tech"], "2": ["pets", "tv"], "3": ["travel", "music"], "4": ["cinema", "geek"]}}
 
+# Метод batch.
+# Аргументы:
+# requests - массив запросов к методам online_score и clients_interests в формате выше, обязательно, не больше 1000
+
+# Ответ:
+# в ответ выдается массив ответов в том же порядке, у каждого свой код
+# [{"code": 200, "response": {"score": 3.0}}, {"code": 403, "error": "Forbidden"} ...]
+
 # Требование: в результате в git должно быть только два(2!) файлика: api.py, test.py.
 # Deadline: следующее занятие
 
 import abc
+import bisect
 import json
+import re
+import collections
 import random
 import datetime
 import logging
 import hashlib
+import hmac
 import uuid
+import time
+import os
+import errno
+import signal
+import threading
+import Queue
+import socket
+import asyncore
+import asynchat
+import mimetools
+from cStringIO import StringIO
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+from multiprocessing.pool import ThreadPool
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -88,8 +118,10 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+NOT_IMPLEMENTED = 501
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
@@ -97,6 +129,9 @@ ERRORS = {
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
+BATCH_SIZE_LIMIT = 1000
+ERROR_BODIES = {code: json.dumps({"error": ERRORS[code], "code": code})
+                for code in (BAD_REQUEST, FORBIDDEN, NOT_FOUND)}
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -134,14 +169,26 @@ class Field(object):
         return bool(value)
 
     def parse(self, value):
-        v = self._get_value(value)
-        if self._has_value(v):
-            if not any(a(v) for a in self.ASSERTS_LIST):
-                raise ValidationError(self.ERROR_TEXT)
-        else:
-            if not self.nullable:
-                raise ValidationError(self.ERROR_TEXT)
-        return v
+        return self.compile()(value)
+
+    def compile(self):
+        # parse() for this field, built once by StructMeta for every request
+        get_value = self._get_value
+        has_value = self._has_value
+        asserts = self.ASSERTS_LIST
+        check = asserts[0] if len(asserts) == 1 else lambda v: any(a(v) for a in asserts)
+        nullable = self.nullable
+        error_text = self.ERROR_TEXT
+
+        def parse(value):
+            v = get_value(value)
+            if has_value(v):
+                if not check(v):
+                    raise ValidationError(error_text)
+            elif not nullable:
+                raise ValidationError(error_text)
+            return v
+        return parse
 
 
 class CharField(Field):
@@ -158,27 +205,48 @@ class EmailField(CharField):
     ERROR_TEXT = 'value is not EmailField'
     ASSERTS_LIST = (lambda v: '@' in v, )
 
-    def parse(self, value):
-        v = CharField(self.required, self.nullable).parse(value)
-        return super(CharField, self).parse(v)
+    def compile(self):
+        nullable = self.nullable
+
+        def parse(value):
+            if value:
+                if not isinstance(value, basestring):
+                    raise ValidationError(CharField.ERROR_TEXT)
+                if '@' not in value:
+                    raise ValidationError(EmailField.ERROR_TEXT)
+            elif not nullable:
+                raise ValidationError(CharField.ERROR_TEXT)
+            return value
+        return parse
 
 
 class PhoneField(Field):
     ERROR_TEXT = 'value is not PhoneField'
-    ASSERTS_LIST = (lambda v: len(v) == 11 and v.startswith('7') and all(c.isdigit() for c in v), )
+    ASSERTS_LIST = (lambda v: len(v) == 11 and v.startswith('7') and v.isdigit(), )
 
     def _get_value(self, value):
         return unicode(value)
 
 
+RE_DATE = re.compile(r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d\d\d\d)\Z')
+
+
+def parse_date(value, error_text):
+    # the same dates as strptime(value, '%d.%m.%Y'), without its overhead
+    m = RE_DATE.match(value) if isinstance(value, basestring) else None
+    if not m:
+        raise ValidationError(error_text)
+    try:
+        return datetime.datetime(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+    except ValueError:
+        raise ValidationError(error_text)
+
+
 class DateField(Field):
     ERROR_TEXT = 'value is not DateField'
 
     def _get_value(self, value):
-        try:
-            return datetime.datetime.strptime(value, '%d.%m.%Y')
-        except ValueError:
-            raise ValidationError(self.ERROR_TEXT)
+        return parse_date(value, self.ERROR_TEXT)
 
 
 class BirthDayField(DateField):
@@ -188,9 +256,8 @@ class BirthDayField(DateField):
     ERROR_TEXT = 'value is not BirthDayField'
     ASSERTS_LIST = (lambda v: (((datetime.datetime.now() - v).days / BirthDayField.DAYS_IN_YEAR) <= BirthDayField.MAX_AGE), )
 
-    def parse(self, value):
-        DateField(self.required, self.nullable).parse(value)
-        return super(DateField, self).parse(value)
+    def _get_value(self, value):
+        return parse_date(value, DateField.ERROR_TEXT)
 
 
 class GenderField(Field):
@@ -207,17 +274,51 @@ class ClientIDsField(Field):
 
 
 class StructMeta(type):
+    # Fields are moved from the class into _fields and their names become
+    # __slots__. _check() is generated once per class: a single function that
+    # runs the compiled parser of every field, unrolled.
     def __new__(cls, name, bases, dct):
         fields = {}
-        for k, v in dct.items():
-            if isinstance(v, Field):
-                fields[k] = v
+        for base in bases:
+            fields.update(getattr(base, '_fields', {}))
+        own = sorted(k for k, v in dct.items() if isinstance(v, Field))
+        for k in own:
+            fields[k] = dct.pop(k)
         dct['_fields'] = fields
+        dct['__slots__'] = tuple(dct.get('__slots__', ())) + tuple(own)
+        dct['_check'] = cls.compile_check(name, fields)
         return type.__new__(cls, name, bases, dct)
 
+    @staticmethod
+    def compile_check(name, fields):
+        namespace = {'ValidationError': ValidationError}
+        lines = ['def _check(self, values):',
+                 '    errors = []',
+                 '    try:']
+        for f in sorted(fields):
+            namespace['parse_' + f] = fields[f].compile()
+            lines += ['        if %r in values:' % f,
+                      '            try:',
+                      '                self.%s = parse_%s(values[%r])' % (f, f, f),
+                      '            except ValidationError as e:',
+                      '                self.%s = None' % f,
+                      '                errors.append(%r %% e)' % ('%s has error %%s' % f),
+                      '        else:',
+                      '            self.%s = None' % f]
+            if fields[f].required:
+                lines.append('            errors.append(%r)' % ('%s not exists' % f))
+        if not fields:
+            lines.append('        pass')
+        lines += ['    except Exception as e:',
+                  "        errors.append('Unknown error %s' % e)",
+                  '    return errors']
+        exec compile('\n'.join(lines), '<%s._check>' % name, 'exec') in namespace
+        return namespace['_check']
+
 
 class Struct(object):
     __metaclass__ = StructMeta
+    __slots__ = ('_values', '_errors')
 
     def __init__(self, values):
         self._values = values
@@ -231,20 +332,7 @@ class Struct(object):
         return '; '.join(self._errors)
 
     def check(self):
-        self.errors = []
-        try:
-            for f, v in self._fields.items():
-                if f not in self._values:
-                    if v.required:
-                        self._errors.append('%s not exists' % f)
-                else:
-                    try:
-                        _v = v.parse(self._values[f])
-                        setattr(self, f, _v)
-                    except ValidationError as E:
-                        self._errors.append('%s has error %s' % (f, E))
-        except Exception as E:
-            self._errors.append('Unknown error %s' % E)
+        self._errors = self._check(self._values)
 
     def _field_has_value(self, field):
         if field in self._values:
@@ -252,6 +340,11 @@ class Struct(object):
         return False
 
 
+class BatchRequestsField(Field):
+    ERROR_TEXT = 'value is not BatchRequestsField'
+    ASSERTS_LIST = (lambda v: isinstance(v, list) and len(v) <= BATCH_SIZE_LIMIT and all(isinstance(e, dict) for e in v), )
+
+
 class ClientsInterestsRequest(Struct):
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
@@ -276,6 +369,10 @@ class OnlineScoreRequest(Struct):
             self._errors.append('Valid fields pairs not found')
 
 
+class BatchRequest(Struct):
+    requests = BatchRequestsField(required=True)
+
+
 class MethodRequest(Struct):
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
@@ -288,53 +385,533 @@ class MethodRequest(Struct):
         return self.login == ADMIN_LOGIN
 
 
-def check_auth(request):
+class StoreError(Exception):
+    pass
+
+
+class LRUCache(object):
+    # Thread-safe mapping of at most size entries, each expiring ttl seconds
+    # after it was set. The least recently used entry is evicted first.
+    # Entries are [prev, next, key, value, expires] links of a circular list
+    # in the order of use, most recent at the end.
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.data = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0] = last
+        link[1] = self.root
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.data.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            prev, next_, _, value, expires = link
+            prev[1] = next_
+            next_[0] = prev
+            if expires is not None and expires <= time.time():
+                del self.data[key]
+                self.misses += 1
+                return default
+            root = self.root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            link = self.data.get(key)
+            if link is not None:
+                self._unlink(link)
+            elif len(self.data) >= self.size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.data[oldest[2]]
+            link = self.data[key] = [None, None, key, value, expires]
+            self._append(link)
+
+
+class KeyValueStub(object):
+    # In-process stand-in for the key-value server. latency seconds are spent
+    # in every call to imitate a slow store. Keys set with a ttl are also kept
+    # in set order, and expired ones, then the oldest beyond max_expiring, are
+    # dropped as new ones come in.
+    def __init__(self, data=None, latency=0, max_expiring=100000):
+        self.data = dict((k, (v, None)) for k, v in (data or {}).items())
+        self.expiring = collections.OrderedDict()
+        self.max_expiring = max_expiring
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def get_many(self, keys):
+        # a single round trip, however many keys
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.time()
+        with self.lock:
+            items = [self.data.get(key, (None, None)) for key in keys]
+        return [value if expires is None or expires > now else None for value, expires in items]
+
+    def set(self, key, value, ttl=None):
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.expiring.pop(key, None)
+            if expires is not None:
+                self.expiring[key] = expires
+                self.purge(now)
+
+    def purge(self, now):
+        expiring = self.expiring
+        while expiring:
+            key = next(iter(expiring))
+            if expiring[key] > now and len(expiring) <= self.max_expiring:
+                break
+            del expiring[key]
+            del self.data[key]
+
+
+class KeyValueHandler(StreamRequestHandler):
+    # one JSON command per line: ["get", key], ["mget", [key, ...]] or
+    # ["set", key, value, ttl]
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = json.loads(line)
+            if command[0] == "get":
+                result = self.server.stub.get(command[1])
+            elif command[0] == "mget":
+                result = self.server.stub.get_many(command[1])
+            elif command[0] == "set":
+                result = self.server.stub.set(*command[1:])
+            else:
+                result = None
+            self.wfile.write(json.dumps(result) + "\n")
+
+
+class KeyValueServer(ThreadingTCPServer):
+    # serves a KeyValueStub over TCP, for StoreClient
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, stub):
+        ThreadingTCPServer.__init__(self, server_address, KeyValueHandler)
+        self.stub = stub
+
+
+class StoreClient(object):
+    # Client of KeyValueServer. Idle connections are kept in a pool, every
+    # socket operation is limited by timeout seconds and a failed call is
+    # retried on a new connection, raising StoreError when all attempts fail.
+    def __init__(self, address, timeout=1.0, retries=3, pool_size=10, backoff=0.05):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = Queue.LifoQueue(pool_size)
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile("rb")
+
+    def release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except Queue.Full:
+            conn[0].close()
+
+    def call(self, *command):
+        line = json.dumps(command) + "\n"
+        error = None
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                conn = self.pool.get_nowait()
+            except Queue.Empty:
+                conn = None
+            try:
+                if conn is None:
+                    conn = self.connect()
+                conn[0].sendall(line)
+                response = conn[1].readline()
+                if not response:
+                    raise socket.error("connection closed by store")
+            except socket.error as e:
+                if conn is not None:
+                    conn[0].close()
+                error = e
+                continue
+            self.release(conn)
+            return json.loads(response)
+        raise StoreError("%s failed: %s" % (command[0], error))
+
+    def get(self, key):
+        return self.call("get", key)
+
+    def get_many(self, keys):
+        return self.call("mget", keys)
+
+    def set(self, key, value, ttl=None):
+        self.call("set", key, value, ttl)
+
+
+class Store(object):
+    # Interests are read from the backend and its failures are passed on.
+    # Scores go through a read-through LRU cache, and backend failures are
+    # only logged for them, so scoring works without the store.
+    # get_many() asks the backend for chunk_size keys per round trip, with up
+    # to fan_out chunks in flight at once.
+    def __init__(self, backend, cache_size=10000, cache_ttl=60 * 60, chunk_size=500, fan_out=1):
+        self.backend = backend
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.chunk_size = chunk_size
+        self.fan_out = fan_out
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def get_pool(self):
+        # created on first use, so that pre-forked workers get their own threads
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.fan_out)
+            return self.pool
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_many(self, keys):
+        chunks = [keys[i:i + self.chunk_size] for i in range(0, len(keys), self.chunk_size)]
+        if self.fan_out > 1 and len(chunks) > 1:
+            results = self.get_pool().map(self.backend.get_many, chunks)
+        else:
+            results = [self.backend.get_many(chunk) for chunk in chunks]
+        return [value for result in results for value in result]
+
+    def cache_get(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            try:
+                value = self.backend.get(key)
+            except StoreError as e:
+                logging.warning("Store is not available: %s" % e)
+                return None
+            if value is not None:
+                self.cache.set(key, value)
+        return value
+
+    def cache_set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl)
+        try:
+            self.backend.set(key, value, ttl)
+        except StoreError as e:
+            logging.warning("Store is not available: %s" % e)
+
+
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+SCORE_TTL = 60 * 60
+
+
+def make_interests_stub(clients=1000, seed=None, latency=0):
+    rnd = random.Random(seed)
+    data = {"i:%d" % cid: json.dumps(rnd.sample(INTERESTS, 2)) for cid in range(clients)}
+    return KeyValueStub(data, latency)
+
+
+DEFAULT_STORE = Store(make_interests_stub())
+
+
+def get_score_key(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    key_parts = [
+        first_name or "",
+        last_name or "",
+        email or "",
+        unicode(phone or ""),
+        birthday.strftime("%Y%m%d") if birthday is not None else "",
+        unicode(gender) if gender is not None else "",
+    ]
+    return "uid:" + hashlib.md5(u"|".join(key_parts).encode("utf-8")).hexdigest()
+
+
+def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, email, birthday, gender, first_name, last_name)
+    score = store.cache_get(key)
+    if score is not None:
+        return score
+    score = 0
+    if phone:
+        score += 1.5
+    if email:
+        score += 1.5
+    if birthday is not None and gender is not None:
+        score += 1.5
+    if first_name and last_name:
+        score += 0.5
+    store.cache_set(key, score, SCORE_TTL)
+    return score
+
+
+def get_interests(store, cid):
+    r = store.get("i:%s" % cid)
+    return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids):
+    cids = list(set(cids))
+    values = store.get_many(["i:%s" % cid for cid in cids])
+    return {cid: JSON_CODEC.loads(r) if r else [] for cid, r in zip(cids, values)}
+
+
+class DigestCache(dict):
+    # Expected partner tokens, read without a lock and cleared when full, as a
+    # digest is cheap to make again. hits and misses are only counted by
+    # get_auth_digest, also without a lock, so a count may get lost.
+    def __init__(self, size):
+        dict.__init__(self)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+
+AUTH_CACHE = LRUCache(1)
+PARTNER_DIGESTS_SIZE = 10000
+PARTNER_DIGESTS = DigestCache(PARTNER_DIGESTS_SIZE)
+
+
+def get_auth_digest(request):
+    # The admin token is cached until the hour it was made for is over,
+    # partner ones in PARTNER_DIGESTS.
     if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        digest = AUTH_CACHE.get(ADMIN_LOGIN)
+        if digest is None:
+            now = datetime.datetime.now()
+            digest = hashlib.sha512(now.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+            next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+            AUTH_CACHE.set(ADMIN_LOGIN, digest, (next_hour - now).total_seconds())
+        return digest
+    key = (request.account, request.login)
+    digest = PARTNER_DIGESTS.get(key)
+    if digest is not None:
+        PARTNER_DIGESTS.hits += 1
+        return digest
+    PARTNER_DIGESTS.misses += 1
+    digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
+    if len(PARTNER_DIGESTS) >= PARTNER_DIGESTS.size:
+        PARTNER_DIGESTS.clear()
+    PARTNER_DIGESTS[key] = digest
+    return digest
+
+
+def check_auth(request):
+    if not isinstance(request.token, basestring):
+        return False
+    try:
+        token = str(request.token)
+    except UnicodeError:
+        return False
+    return hmac.compare_digest(get_auth_digest(request), token)
+
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BUCKET_BOUNDS = LATENCY_BUCKETS + ("+Inf", )
+
+
+class Histogram(object):
+    # latencies counted in LATENCY_BUCKETS by upper bound, the last count is
+    # for anything slower
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+    def quantile(self, counts, q):
+        # upper bound of the bucket holding the q-th quantile, None when empty
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        counts = list(self.counts)
+        return {
+            "count": sum(counts),
+            "sum": self.sum,
+            "p50": self.quantile(counts, 0.5),
+            "p99": self.quantile(counts, 0.99),
+            "buckets": [[bound, count] for bound, count in zip(BUCKET_BOUNDS, counts) if count],
+        }
+
+
+class Metrics(object):
+    # Counters of all requests and stage latencies of the last window ones,
+    # in one process. Recording is two counter increments and a deque append;
+    # histograms are built from the window when a snapshot is taken. There
+    # are no locks: a concurrent increment may rarely be lost, which doesn't
+    # matter for monitoring. Metric names are bounded by the known methods.
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.requests = collections.Counter()
+        self.codes = collections.Counter()
+        self.recent = collections.deque(maxlen=window)
+
+    def record(self, method, code, timings):
+        # timings are (stage, seconds) pairs of one request
+        self.requests[method] += 1
+        self.codes[code] += 1
+        self.recent.append((method, timings))
+
+    def snapshot(self):
+        histograms = {}
+        recent = list(self.recent)
+        for method, timings in recent:
+            stages = histograms.setdefault(method, {})
+            for stage, seconds in timings:
+                histogram = stages.get(stage)
+                if histogram is None:
+                    histogram = stages[stage] = Histogram()
+                histogram.add(seconds)
+        return {
+            "uptime": time.time() - self.started,
+            "requests": dict(self.requests),
+            "codes": dict((str(code), count) for code, count in self.codes.items()),
+            "window": len(recent),
+            "latency": dict((method, dict((stage, histogram.snapshot()) for stage, histogram in stages.items()))
+                            for method, stages in histograms.items()),
+        }
+
+
+METRICS = Metrics()
+
+
+def get_metrics(store):
+    result = METRICS.snapshot()
+    caches = {"auth": AUTH_CACHE, "partner_auth": PARTNER_DIGESTS, "score": (store or DEFAULT_STORE).cache}
+    result["caches"] = dict((name, {"size": len(cache), "hits": cache.hits, "misses": cache.misses})
+                            for name, cache in caches.items())
+    return result
+
+
+def online_score_proc(req_obj, method_request, context, store):
+    context['has'] = [f for f in req_obj._values if req_obj._field_has_value(f)]
+    result = {}
+    if method_request.is_admin:
+        result['score'] = 42
     else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
-
-
-def online_score_proc(request_type, args, method_request, context):
-    req_obj = request_type(args)
-    if req_obj.is_valid():
-        context['has'] = [f for f in req_obj._values if req_obj._field_has_value(f)]
-        result = {}
-        if method_request.is_admin:
-            result['score'] = 42
-        else:
-            result['score'] = 8
-        return result, OK
-    return req_obj.get_errors(), INVALID_REQUEST
+        result['score'] = get_score(store, **{f: getattr(req_obj, f) for f in context['has']})
+    return result, OK
 
 
-def clients_interests_proc(request_type, args, method_request, context):
-    req_obj = request_type(args)
-    if req_obj.is_valid():
-        context['nclients'] = len(req_obj.client_ids)
-        result = {'client_id' + str(c): ['a', 'b'] for c in req_obj.client_ids}
-        return result, OK
-    return req_obj.get_errors(), INVALID_REQUEST
+def clients_interests_proc(req_obj, method_request, context, store):
+    context['nclients'] = len(req_obj.client_ids)
+    interests = get_interests_many(store, req_obj.client_ids)
+    result = {'client_id' + str(c): interests[c] for c in req_obj.client_ids}
+    return result, OK
 
 
-def method_handler(request, ctx):
+def batch_proc(req_obj, method_request, context, store):
+    # Every item is a method request of its own and gets its own code.
+    # Credentials are checked once per distinct account, login and token.
+    verified = {(method_request.account, method_request.login, method_request.token): True}
+    result = []
+    for item in req_obj.requests:
+        if item.get('method') == 'batch':
+            response, code = 'Batch requests can not be nested', INVALID_REQUEST
+        else:
+            try:
+                response, code = method_handler({"body": item}, {}, store, verified)
+            except Exception, e:
+                logging.exception("Unexpected error: %s" % e)
+                response, code = None, INTERNAL_ERROR
+        result.append(make_response(response, code))
+    context['nrequests'] = len(result)
+    return result, OK
+
+
+def method_handler(request, ctx, store=None, verified=None):
+    # verified maps (account, login, token) to results of check_auth
+    store = store or DEFAULT_STORE
     METHODS = {
         'online_score': (online_score_proc, OnlineScoreRequest),
         'clients_interests': (clients_interests_proc, ClientsInterestsRequest),
+        'batch': (batch_proc, BatchRequest),
     }
 
+    # stages are timed into ctx['timings'] for METRICS, unknown methods as 'other'
+    start = time.time()
     method_request = MethodRequest(request['body'])
     if not method_request.is_valid():
         return method_request.get_errors(), INVALID_REQUEST
-    if not check_auth(method_request):
+    validated = time.time()
+    if verified is None:
+        authorized = check_auth(method_request)
+    else:
+        key = (method_request.account, method_request.login, method_request.token)
+        authorized = verified.get(key)
+        if authorized is None:
+            authorized = verified[key] = check_auth(method_request)
+    authenticated = time.time()
+    ctx['method'] = method_request.method if method_request.method in METHODS else 'other'
+    ctx['timings'] = timings = [('auth', authenticated - validated)]
+    if not authorized:
         return None, FORBIDDEN
     method_proc = METHODS.get(method_request.method)
     if not method_proc:
         return 'Method proc not found', NOT_FOUND
-    response, code = method_proc[0](method_proc[1], request['body']['arguments'], method_request, ctx)
+    req_obj = method_proc[1](request['body']['arguments'])
+    valid = req_obj.is_valid()
+    handler_start = time.time()
+    timings.append(('validation', validated - start + handler_start - authenticated))
+    if not valid:
+        return req_obj.get_errors(), INVALID_REQUEST
+    response, code = method_proc[0](req_obj, method_request, ctx, store)
+    timings.append(('handler', time.time() - handler_start))
     return response, code
 
 
@@ -342,55 +919,443 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
+    get_router = {
+        "metrics": get_metrics
+    }
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
     def do_POST(self):
-        response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
-        request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
         except:
-            code = BAD_REQUEST
-
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context)
-                except Exception, e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+            data_string = None
+        store = getattr(self.server, "store", None)
+        code, body = handle_request(self.router, store, self.path, self.headers, data_string, context)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+        return
 
+    def do_GET(self):
+        code, body = handle_get(self.get_router, getattr(self.server, "store", None), self.path)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        self.wfile.write(body)
+
+
+JSONCodec = collections.namedtuple("JSONCodec", "name loads dumps")
+JSON_CODECS = {"json": JSONCodec("json", json.loads, json.dumps)}
+if ujson is not None:
+    JSON_CODECS["ujson"] = JSONCodec("ujson", ujson.loads, lambda obj: ujson.dumps(obj, escape_forward_slashes=False))
+
+
+def get_json_codec(name=None):
+    # the fastest one available by default
+    if name is None:
+        name = "ujson" if "ujson" in JSON_CODECS else "json"
+    return JSON_CODECS[name]
+
+
+JSON_CODEC = get_json_codec()
+# share of requests written to the access log, errors are always logged
+ACCESS_LOG_SAMPLE = 1.0
+
+
+def make_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def handle_request(router, store, path, headers, data_string, context):
+    # shared by the blocking handler and the event loop channel
+    start = time.time()
+    response, code = {}, OK
+    request = None
+    try:
+        request = JSON_CODEC.loads(data_string)
+    except:
+        code = BAD_REQUEST
+    decoded = time.time()
+
+    log_access = ACCESS_LOG_SAMPLE >= 1 or random.random() < ACCESS_LOG_SAMPLE
+    if request:
+        if log_access:
+            logging.info("%s: %s %s", path, data_string, context["request_id"])
+        route = path.strip("/")
+        if route in router:
+            try:
+                response, code = router[route]({"body": request, "headers": headers}, context, store)
+            except Exception, e:
+                logging.exception("Unexpected error: %s" % e)
+                code = INTERNAL_ERROR
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+            code = NOT_FOUND
+
+    r = make_response(response, code)
+    timings = context.pop('timings', [])
+    if log_access or code == INTERNAL_ERROR:
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+    encode_start = time.time()
+    if not response and code in ERROR_BODIES:
+        body = ERROR_BODIES[code]
+    else:
+        body = JSON_CODEC.dumps(r)
+    end = time.time()
+    timings += [('decode', decoded - start), ('encode', end - encode_start), ('total', end - start)]
+    METRICS.record(context.get('method', 'other'), code, timings)
+    return code, body
+
+
+def handle_get(router, store, path):
+    route = path.partition("?")[0].strip("/")
+    if route not in router:
+        return NOT_FOUND, ERROR_BODIES[NOT_FOUND]
+    return OK, JSON_CODEC.dumps(router[route](store))
+
+class ThreadPoolHTTPServer(HTTPServer):
+    # Accepted connections are handled by a fixed pool of threads. The pool is
+    # started by start_pool() in the serving process, so the server can be
+    # created before forking workers.
+    def __init__(self, server_address, handler_class, pool_size):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.pool_size = pool_size
+        self.requests = Queue.Queue()
+        self.pool = []
+
+    def start_pool(self):
+        for _ in range(self.pool_size):
+            t = threading.Thread(target=self.process_request_thread)
+            t.daemon = True
+            t.start()
+            self.pool.append(t)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_request_thread(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        # queued connections are still served before the threads stop
+        HTTPServer.server_close(self)
+        for _ in self.pool:
+            self.requests.put(None)
+        for t in self.pool:
+            t.join()
+        self.pool = []
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    # One keep-alive connection. Requests are read without blocking: first the
+    # header block up to the blank line, then exactly Content-Length bytes of
+    # body. Pipelined requests are answered in the order they arrived, since
+    # responses go through the channel's output fifo.
+    MAX_HEADER_SIZE = 65536
+    # a batch of BATCH_SIZE_LIMIT requests fits well within it
+    MAX_BODY_SIZE = 1024 * 1024
+    # send responses in one piece, small trailing segments would otherwise
+    # wait for the client's delayed ACK
+    ac_out_buffer_size = 65536
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.last_activity = time.time()
+        self.set_terminator("\r\n\r\n")
+        self.reset()
+
+    def reset(self):
+        self.buffer = []
+        self.size = 0
+        self.request_line = None
+        self.headers = None
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.headers is None and self.size > self.MAX_HEADER_SIZE:
+            self.send_error(BAD_REQUEST)
+
+    def found_terminator(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if self.headers is None:
+            if not data.strip():
+                return
+            self.parse_headers(data)
+        else:
+            self.dispatch(data)
+
+    def parse_headers(self, data):
+        request_line, _, header_block = data.lstrip("\r\n").partition("\r\n")
+        words = request_line.split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            return self.send_error(BAD_REQUEST)
+        self.request_line = words
+        self.headers = mimetools.Message(StringIO(header_block + "\r\n\r\n"))
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.send_error(BAD_REQUEST)
+        if length > self.MAX_BODY_SIZE:
+            return self.send_error(REQUEST_TOO_LARGE)
+        if length:
+            self.set_terminator(length)
+        else:
+            self.dispatch("")
+
+    def get_request_id(self, headers):
+        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+
+    def keep_alive(self):
+        connection = self.headers.get("Connection", "").lower()
+        if self.request_line[2] == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def dispatch(self, data_string):
+        method, path, _ = self.request_line
+        if method == "GET":
+            code, body = handle_get(self.server.get_router, self.server.store, path)
+        elif method != "POST":
+            code, body = NOT_IMPLEMENTED, ""
+        else:
+            context = {"request_id": self.get_request_id(self.headers)}
+            code, body = handle_request(self.server.router, self.server.store, path, self.headers, data_string or None, context)
+        keep_alive = self.keep_alive()
+        self.send_response(code, body, keep_alive)
+        if keep_alive:
+            self.reset()
+            self.set_terminator("\r\n\r\n")
+        else:
+            self.close_when_done()
+
+    def send_response(self, code, body, keep_alive=True):
+        reason = BaseHTTPRequestHandler.responses.get(code, ("",))[0]
+        head = ["HTTP/1.1 %d %s" % (code, reason),
+                "Content-Type: application/json",
+                "Content-Length: %d" % len(body)]
+        if not keep_alive:
+            head.append("Connection: close")
+        self.push("\r\n".join(head) + "\r\n\r\n" + body)
+
+    def send_error(self, code):
+        # the stream can't be trusted past a malformed request
+        self.set_terminator(None)
+        self.buffer = []
+        self.send_response(code, "", keep_alive=False)
+        self.close_when_done()
+
+    def handle_write(self):
+        self.last_activity = time.time()
+        asynchat.async_chat.handle_write(self)
+
+    def handle_error(self):
+        logging.exception("Unexpected error in connection")
+        self.close()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    # Single-threaded event loop serving any number of keep-alive connections.
+    # The interface mirrors HTTPServer enough for serve() and serve_prefork().
+    # Handlers run in the loop, so they must not block: a remote store (-s)
+    # can take timeout * retries per call and is refused with -a.
+    # Connections idle for idle_timeout seconds are closed. Beyond
+    # max_connections, or for accept_backoff seconds after accept failed for
+    # lack of descriptors, new connections wait in the listen backlog.
+    router = MainHTTPHandler.router
+    get_router = MainHTTPHandler.get_router
+    request_queue_size = 1024
+    store = None
+    idle_timeout = 60
+    max_connections = 1000
+    accept_backoff = 1.0
+
+    def __init__(self, server_address):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.stopped = threading.Event()
+        self.accept_paused_until = 0
+
+    def readable(self):
+        return len(self.map) <= self.max_connections and time.time() >= self.accept_paused_until
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error as e:
+            if e.args[0] not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                raise
+            logging.error("Can't accept connections: %s" % e)
+            self.accept_paused_until = time.time() + self.accept_backoff
+            return
+        if pair is not None:
+            AsyncHTTPChannel(pair[0], self)
+
+    def close_idle(self, now):
+        for channel in self.map.values():
+            if channel is not self and now - channel.last_activity > self.idle_timeout:
+                channel.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        # the stop flag is reset on the way out, a shutdown() that comes before
+        # the loop started must not be lost
+        next_check = 0
+        try:
+            while not self.stopped.is_set():
+                asyncore.loop(timeout=poll_interval, use_poll=True, map=self.map, count=1)
+                now = time.time()
+                if now >= next_check:
+                    self.close_idle(now)
+                    next_check = now + poll_interval
+        finally:
+            self.stopped.clear()
+
+    def shutdown(self):
+        self.stopped.set()
+
+    def server_close(self, timeout=5.0):
+        # stop accepting, then give pending responses a chance to be sent
+        self.close()
+        for channel in self.map.values():
+            channel.close_when_done()
+        deadline = time.time() + timeout
+        while self.map and time.time() < deadline:
+            asyncore.loop(timeout=0.1, use_poll=True, map=self.map, count=1)
+        asyncore.close_all(self.map)
+
+    def handle_error(self):
+        logging.exception("Unexpected error in server")
+
+
+def make_server(server_address, threads=0, event_loop=False, store=None):
+    if event_loop:
+        server = AsyncHTTPServer(server_address)
+    elif threads > 0:
+        server = ThreadPoolHTTPServer(server_address, MainHTTPHandler, threads)
+    else:
+        server = HTTPServer(server_address, MainHTTPHandler)
+    server.store = store
+    return server
+
+
+def serve(server):
+    # serves until SIGTERM or Ctrl-C, letting in-flight requests finish
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), so it can't run in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    if isinstance(server, ThreadPoolHTTPServer):
+        server.start_pool()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def serve_prefork(server, workers):
+    # Forked workers accept on the listening socket of server. SIGTERM or
+    # Ctrl-C in the parent is passed on to them, and the parent waits until
+    # all of them have stopped.
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(server)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    break
+    server.server_close()
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-sample", action="store", type=float, default=1.0,
+                  help="share of requests written to the access log")
+    op.add_option("--json", action="store", choices=sorted(JSON_CODECS), default=JSON_CODEC.name,
+                  help="JSON codec, one of %s" % ", ".join(sorted(JSON_CODECS)))
+    op.add_option("-t", "--threads", action="store", type=int, default=0,
+                  help="serve requests in a pool of this many threads")
+    op.add_option("-w", "--workers", action="store", type=int, default=0,
+                  help="pre-fork this many processes sharing the listening socket")
+    op.add_option("-a", "--async", action="store_true", dest="event_loop", default=False,
+                  help="serve keep-alive connections from a non-blocking event loop")
+    op.add_option("-s", "--store", action="store", default=None,
+                  help="host:port of the key-value store, an in-process stub is used by default")
+    op.add_option("--store-timeout", action="store", type=float, default=1.0)
+    op.add_option("--store-retries", action="store", type=int, default=3)
+    op.add_option("--store-chunk", action="store", type=int, default=500,
+                  help="keys per multi-get request to the store")
+    op.add_option("--store-fan-out", action="store", type=int, default=1,
+                  help="multi-get requests in flight at once for one lookup")
     (opts, args) = op.parse_args()
+    if opts.event_loop and opts.threads:
+        op.error("-a serves every connection from one event loop thread and can't be combined with -t")
+    if opts.event_loop and opts.store:
+        op.error("-a can't be combined with -s: a blocking store call would stall every connection of the event loop")
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    JSON_CODEC = get_json_codec(opts.json)
+    ACCESS_LOG_SAMPLE = opts.log_sample
+    store = None
+    if opts.store:
+        host, _, port = opts.store.rpartition(":")
+        store = Store(StoreClient((host or "localhost", int(port)), opts.store_timeout, opts.store_retries,
+                                  pool_size=max(10, opts.store_fan_out)),
+                      chunk_size=opts.store_chunk, fan_out=opts.store_fan_out)
+    server = make_server(("localhost", opts.port), opts.threads, opts.event_loop, store)
     logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    if opts.workers > 1:
+        serve_prefork(server, opts.workers)
+    else:
+        serve(server)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cost of a clients_interests request with many client_ids:
+#   python benchmark.py [--ids 10000] [--latency 0.0005]
+# The store is a KeyValueServer on a local port, latency seconds are added to
+# every round trip. One-by-one lookups are compared with multi-gets for
+# several chunk sizes and fan-outs, and one-shot JSON encoding of the
+# response with incremental (streamed) encoding.
+#
+# Cost of request validation, in microseconds per request:
+#   python benchmark.py --validation [--requests 20000]
+#
+# Cost of handle_request (decoding, method, encoding) with every available
+# JSON codec, access logging off:
+#   python benchmark.py --codecs [--requests 20000]
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from optparse import OptionParser
+
+import api
+
+REPEAT = 3
+CHUNK_SIZES = (100, 500, 2000)
+FAN_OUTS = (1, 4)
+VALIDATION_CASES = (
+    ("method", api.MethodRequest,
+     {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "55cc9ce545bcd144",
+      "arguments": {"phone": "79175002040"}}),
+    ("online_score", api.OnlineScoreRequest,
+     {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": u"Стансилав",
+      "last_name": u"Ступников", "birthday": "01.01.1990", "gender": 1}),
+    ("online_score invalid", api.OnlineScoreRequest,
+     {"phone": "89175002040", "email": "stupnikovotus.ru", "birthday": "XXX", "gender": -1}),
+    ("clients_interests", api.ClientsInterestsRequest,
+     {"client_ids": [1, 2, 3, 4], "date": "20.07.2017"}),
+)
+
+
+def best_time(func, repeat=REPEAT):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def interests_request(ids):
+    request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+               "arguments": {"client_ids": range(ids), "date": "20.07.2017"}}
+    request["token"] = hashlib.sha512(request["account"] + request["login"] + api.SALT).hexdigest()
+    return {"body": request, "headers": {}}
+
+
+def bench_interests(address, opts):
+    client = api.StoreClient(address, pool_size=max(FAN_OUTS))
+    request = interests_request(opts.ids)
+    cids = request["body"]["arguments"]["client_ids"]
+
+    store = api.Store(client)
+    elapsed = best_time(lambda: [api.get_interests(store, cid) for cid in cids], repeat=1)
+    print("one by one                  %8.3f s" % elapsed)
+
+    for chunk_size in CHUNK_SIZES:
+        for fan_out in FAN_OUTS:
+            store = api.Store(client, chunk_size=chunk_size, fan_out=fan_out)
+            elapsed = best_time(lambda: api.method_handler(request, {}, store))
+            print("chunk %5d, fan-out %d      %8.3f s" % (chunk_size, fan_out, elapsed))
+
+    response, code = api.method_handler(request, {}, api.Store(client))
+    body = {"response": response, "code": code}
+    encoder = json.JSONEncoder()
+    print("encode one-shot             %8.3f s" % best_time(lambda: json.dumps(body)))
+    print("encode streamed             %8.3f s" % best_time(lambda: list(encoder.iterencode(body))))
+
+
+def bench_validation(opts):
+    for name, request_type, values in VALIDATION_CASES:
+        def validate():
+            for _ in xrange(opts.requests):
+                request_type(values).is_valid()
+        print("%-22s %8.2f us" % (name, best_time(validate) / opts.requests * 1e6))
+
+
+def bench_codecs(opts):
+    score = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+             "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+    score["token"] = hashlib.sha512(score["account"] + score["login"] + api.SALT).hexdigest()
+    cases = (("online_score", json.dumps(score), opts.requests),
+             ("clients_interests 1000", json.dumps(interests_request(1000)["body"]), opts.requests // 100))
+    logging.disable(logging.INFO)
+    for name in sorted(api.JSON_CODECS):
+        api.JSON_CODEC = api.JSON_CODECS[name]
+        for case, data_string, requests in cases:
+            def handle():
+                for _ in xrange(requests):
+                    api.handle_request(api.MainHTTPHandler.router, None, "/method/", {}, data_string,
+                                       {"request_id": "1"})
+            print("%-6s %-22s %8.2f us" % (name, case, best_time(handle) / requests * 1e6))
+
+
+def main():
+    op = OptionParser()
+    op.add_option("--ids", action="store", type=int, default=10000,
+                  help="client_ids in the request")
+    op.add_option("--latency", action="store", type=float, default=0.0005,
+                  help="seconds added to every store round trip")
+    op.add_option("--validation", action="store_true", default=False,
+                  help="measure request validation instead")
+    op.add_option("--requests", action="store", type=int, default=20000,
+                  help="requests validated per measurement")
+    op.add_option("--codecs", action="store_true", default=False,
+                  help="measure request handling with every JSON codec instead")
+    (opts, args) = op.parse_args()
+    if opts.codecs:
+        bench_codecs(opts)
+        return
+    if opts.validation:
+        bench_validation(opts)
+        return
+
+    server = api.KeyValueServer(("localhost", 0), api.make_interests_stub(opts.ids, latency=opts.latency))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        bench_interests(server.server_address, opts)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Load test of the scoring API:
+#   python load_test.py [--concurrency 8] [--duration 10] [--keep-alive] [--server-args "-a"]
+# api.py is started on a free local port with --server-args, or --connect
+# host:port uses a running server. concurrency threads replay a mix of
+# requests (--mix name=weight,... of SCENARIOS) for duration seconds or
+# --requests requests, and requests/sec, latency percentiles per scenario
+# and response codes are reported. The server's own stage latencies are at
+# GET /metrics.
+#
+# Without --keep-alive every request opens a new connection. The threaded
+# server answers in HTTP/1.0 and closes connections anyway, only the event
+# loop one (-a) keeps them open. Admin requests get new tokens when the
+# hour changes during a run.
+
+import bisect
+import collections
+import datetime
+import hashlib
+import httplib
+import itertools
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import api
+
+HEADERS = {"Content-Type": "application/json"}
+DEFAULT_MIX = "score=60,score_invalid=10,score_admin=5,bad_auth=5,interests=15,interests_large=5"
+BODIES_PER_SCENARIO = 200
+# admin tokens are only valid in the hour they were made in
+HOURLY_SCENARIOS = ("score_admin", )
+USERS = 1000
+SERVER_START_TIMEOUT = 10
+
+
+def method_request(method, arguments, login="h&f", account="horns&hoofs"):
+    request = {"account": account, "login": login, "method": method, "arguments": arguments}
+    if login == api.ADMIN_LOGIN:
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+    else:
+        msg = account + login + api.SALT
+    request["token"] = hashlib.sha512(msg).hexdigest()
+    return request
+
+
+def score_arguments(rnd):
+    # one of USERS distinct users, so the score cache is hit as in production
+    user = rnd.randrange(USERS)
+    return {"phone": "7%010d" % user, "email": "user%d@otus.ru" % user, "first_name": "first%d" % user,
+            "last_name": "last%d" % user, "birthday": "01.01.%d" % (1960 + user % 50), "gender": user % 3}
+
+
+def score(rnd, opts):
+    return method_request("online_score", score_arguments(rnd))
+
+
+def score_invalid(rnd, opts):
+    arguments = score_arguments(rnd)
+    arguments.update(phone="8" + arguments["phone"][1:], email="otus.ru", gender=-1)
+    return method_request("online_score", arguments)
+
+
+def score_admin(rnd, opts):
+    return method_request("online_score", score_arguments(rnd), login=api.ADMIN_LOGIN)
+
+
+def bad_auth(rnd, opts):
+    return dict(score(rnd, opts), token="bad")
+
+
+def interests(rnd, opts):
+    return method_request("clients_interests", {"client_ids": rnd.sample(xrange(USERS), rnd.randint(1, 10)),
+                                                "date": "20.07.2017"})
+
+
+def interests_large(rnd, opts):
+    return method_request("clients_interests", {"client_ids": rnd.sample(xrange(USERS * 10), opts.large_ids)})
+
+
+SCENARIOS = {
+    "score": score,
+    "score_invalid": score_invalid,
+    "score_admin": score_admin,
+    "bad_auth": bad_auth,
+    "interests": interests,
+    "interests_large": interests_large,
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise ValueError("unknown scenario %s, expected one of %s" % (name, ", ".join(sorted(SCENARIOS))))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def make_bodies(weights, opts):
+    rnd = random.Random(opts.seed)
+    return dict((name, [json.dumps(SCENARIOS[name](rnd, opts)) for _ in range(BODIES_PER_SCENARIO)])
+                for name in weights)
+
+
+def next_hour():
+    hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    return time.mktime(hour.timetuple())
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, server_args):
+    api_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py")
+    log = open(os.devnull, "w")
+    process = subprocess.Popen([sys.executable, api_path, "-p", str(port), "-l", os.devnull] +
+                               shlex.split(server_args), stdout=log, stderr=log)
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("api.py exited with code %s" % process.returncode)
+        try:
+            socket.create_connection(("localhost", port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("api.py did not start in %d seconds" % SERVER_START_TIMEOUT)
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait()
+
+
+def worker(address, bodies, weights, opts, deadline, budget, results):
+    rnd = random.Random()
+    names = sorted(weights)
+    cumulative = []
+    for name in names:
+        cumulative.append(weights[name] + (cumulative[-1] if cumulative else 0))
+    latencies = collections.defaultdict(list)
+    codes = collections.Counter()
+    errors = 0
+    conn = None
+    hourly = dict((name, weights[name]) for name in HOURLY_SCENARIOS if name in weights)
+    refresh_at = next_hour()
+    while time.time() < deadline and next(budget) < opts.requests:
+        if hourly and time.time() >= refresh_at:
+            # the hour is read before the tokens, so a change in between only refreshes them once more
+            refresh_at = next_hour()
+            bodies = dict(bodies, **make_bodies(hourly, opts))
+        name = names[bisect.bisect_right(cumulative, rnd.random() * cumulative[-1])]
+        body = rnd.choice(bodies[name])
+        start = time.time()
+        try:
+            if conn is None:
+                conn = httplib.HTTPConnection(address[0], address[1], timeout=opts.timeout)
+            conn.request("POST", "/method/", body, HEADERS)
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            errors += 1
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        latencies[name].append(time.time() - start)
+        codes[response.status] += 1
+        if not opts.keep_alive:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    results.append((latencies, codes, errors))
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(results, elapsed):
+    latencies = collections.defaultdict(list)
+    codes = collections.Counter()
+    errors = 0
+    for worker_latencies, worker_codes, worker_errors in results:
+        for name, values in worker_latencies.items():
+            latencies[name].extend(values)
+        codes.update(worker_codes)
+        errors += worker_errors
+    latencies["all"] = list(itertools.chain.from_iterable(latencies.values()))
+    total = len(latencies["all"])
+
+    print("%d requests in %.1f s, %.1f req/s, %d errors" % (total, elapsed, total / elapsed, errors))
+    print("%-16s %8s %8s %8s %8s %8s" % ("scenario", "requests", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name in sorted(latencies, key=lambda n: (n == "all", n)):
+        values = sorted(latencies[name])
+        if not values:
+            continue
+        print("%-16s %8d %8.2f %8.2f %8.2f %8.2f" % (
+            name, len(values), percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000,
+            percentile(values, 0.99) * 1000, values[-1] * 1000))
+    print("codes: %s" % ", ".join("%s: %d" % item for item in sorted(codes.items())))
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8,
+                  help="client threads")
+    op.add_option("-d", "--duration", action="store", type=float, default=10,
+                  help="seconds to run")
+    op.add_option("-n", "--requests", action="store", type=int, default=sys.maxint,
+                  help="stop after this many requests")
+    op.add_option("-k", "--keep-alive", action="store_true", default=False,
+                  help="reuse connections between requests")
+    op.add_option("--mix", action="store", default=DEFAULT_MIX,
+                  help="scenario=weight,... out of %s" % ", ".join(sorted(SCENARIOS)))
+    op.add_option("--large-ids", action="store", type=int, default=1000,
+                  help="client_ids in interests_large requests")
+    op.add_option("--server-args", action="store", default="",
+                  help="options of the started api.py, e.g. \"-a\" or \"-t 8 -w 2\"")
+    op.add_option("--connect", action="store", default=None,
+                  help="host:port of a running server instead of starting one")
+    op.add_option("--timeout", action="store", type=float, default=10)
+    op.add_option("--seed", action="store", type=int, default=0)
+    (opts, args) = op.parse_args()
+
+    try:
+        weights = parse_mix(opts.mix)
+    except ValueError as e:
+        op.error(str(e))
+    bodies = make_bodies(weights, opts)
+
+    process = None
+    if opts.connect:
+        host, _, port = opts.connect.rpartition(":")
+        address = (host or "localhost", int(port))
+    else:
+        address = ("localhost", get_free_port())
+        process = start_server(address[1], opts.server_args)
+    try:
+        results = []
+        budget = itertools.count()
+        start = time.time()
+        deadline = start + opts.duration
+        threads = [threading.Thread(target=worker, args=(address, bodies, weights, opts, deadline, budget, results))
+                   for _ in range(opts.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report(results, time.time() - start)
+    finally:
+        if process is not None:
+            stop_server(process)
+
+
+if __name__ == "__main__":
+    main()
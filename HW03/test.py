@@ -1,6 +1,12 @@
 import hashlib
 import datetime
+import errno
 import functools
+import json
+import threading
+import httplib
+import socket
+import time
 import unittest
 
 import api
@@ -45,6 +51,40 @@ class TestSuite(unittest.TestCase):
         _, code = self.get_response(request)
         self.assertEqual(api.FORBIDDEN, code)
 
+    def test_auth_cache(self):
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        self.get_response(request)
+        hits = api.AUTH_CACHE.hits
+        _, code = self.get_response(dict(request, token=request["token"][:-1] + "x"))
+        self.assertEqual(api.FORBIDDEN, code)
+        _, code = self.get_response(dict(request, token=u"\u0439"))
+        self.assertEqual(api.FORBIDDEN, code)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual(hits + 2, api.AUTH_CACHE.hits)
+
+    def test_partner_auth_cache(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        self.get_response(request)
+        hits, misses = api.PARTNER_DIGESTS.hits, api.PARTNER_DIGESTS.misses
+        _, code = self.get_response(dict(request, token=request["token"][:-1] + "x"))
+        self.assertEqual(api.FORBIDDEN, code)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual((hits + 2, misses), (api.PARTNER_DIGESTS.hits, api.PARTNER_DIGESTS.misses))
+
+    def test_admin_auth_cache_expires(self):
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        api.AUTH_CACHE.set(api.ADMIN_LOGIN, request["token"], ttl=0)
+        _, code = self.get_response(dict(request, token=request["token"].upper()))
+        self.assertEqual(api.FORBIDDEN, code)
+        api.AUTH_CACHE.set(api.ADMIN_LOGIN, "stale", ttl=0)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
     @cases([
         {"account": "horns&hoofs", "login": "h&f", "method": "online_score"},
         {"account": "horns&hoofs", "login": "h&f", "arguments": {}},
@@ -70,6 +110,7 @@ class TestSuite(unittest.TestCase):
          "first_name": "s", "last_name": 2},
         {"phone": "79175002040", "birthday": "01.01.2000", "first_name": "s"},
         {"email": "stupnikov@otus.ru", "gender": 1, "last_name": 2},
+        {"phone": "79175002040", "email": "stupnikov@otus.ru", "birthday": None},
     ])
     def test_invalid_score_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
@@ -97,6 +138,12 @@ class TestSuite(unittest.TestCase):
         self.assertTrue(isinstance(score, (int, float)) and score >= 0, arguments)
         self.assertEqual(sorted(self.context["has"]), sorted(arguments.keys()))
 
+    def test_request_slots(self):
+        request = api.OnlineScoreRequest({"first_name": "a", "last_name": "b"})
+        self.assertTrue(request.is_valid())
+        self.assertEqual(("a", "b", None), (request.first_name, request.last_name, request.phone))
+        self.assertFalse(hasattr(request, "__dict__"))
+
     def test_ok_score_admin_request(self):
         arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
         request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": arguments}
@@ -106,6 +153,46 @@ class TestSuite(unittest.TestCase):
         score = response.get("score")
         self.assertEqual(score, 42)
 
+    def test_batch_request(self):
+        score = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                 "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        interests = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                     "arguments": {"client_ids": [1, 2]}}
+        admin = {"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                 "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        for r in (score, interests, admin):
+            self.set_valid_auth(r)
+        items = [score, interests, admin, dict(score, token="bad"), dict(score, arguments={}),
+                 dict(score, method="unknown"), {"login": "h&f"}, dict(score, method="batch")]
+        request = dict(score, method="batch", arguments={"requests": items})
+
+        checked = []
+        check_auth = api.check_auth
+        api.check_auth = lambda r: checked.append(r.login) or check_auth(r)
+        try:
+            response, code = self.get_response(request)
+        finally:
+            api.check_auth = check_auth
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.OK, api.OK, api.OK, api.FORBIDDEN, api.INVALID_REQUEST, api.NOT_FOUND,
+                          api.INVALID_REQUEST, api.INVALID_REQUEST], [r["code"] for r in response])
+        self.assertEqual(42, response[2]["response"]["score"])
+        self.assertEqual(2, len(response[1]["response"]))
+        self.assertEqual(["h&f", "admin", "h&f"], checked)
+        self.assertEqual(len(items), self.context["nrequests"])
+
+    @cases([
+        {},
+        {"requests": {}},
+        {"requests": [1]},
+        {"requests": [{}] * (api.BATCH_SIZE_LIMIT + 1)},
+    ])
+    def test_invalid_batch_request(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch", "arguments": arguments}
+        self.set_valid_auth(request)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+
     @cases([
         {},
         {"date": "20.07.2017"},
@@ -136,5 +223,298 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+
+def valid_score_request():
+    request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+               "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+    request["token"] = hashlib.sha512(request["account"] + request["login"] + api.SALT).hexdigest()
+    return request
+
+
+class TestHandleRequest(unittest.TestCase):
+    def handle(self, path, data_string):
+        return api.handle_request(api.MainHTTPHandler.router, None, path, {}, data_string, {"request_id": "1"})
+
+    @cases(sorted(api.JSON_CODECS))
+    def test_json_codec(self, name):
+        codec = api.JSON_CODEC
+        api.JSON_CODEC = api.JSON_CODECS[name]
+        try:
+            code, body = self.handle("/method/", json.dumps(valid_score_request()))
+            self.assertEqual(api.OK, code)
+            self.assertEqual({"code": api.OK, "response": {"score": 3.0}}, json.loads(body))
+            code, body = self.handle("/method/", "{")
+            self.assertEqual(api.BAD_REQUEST, code)
+            self.assertEqual(api.ERROR_BODIES[api.BAD_REQUEST], body)
+        finally:
+            api.JSON_CODEC = codec
+
+    def test_error_bodies(self):
+        request = dict(valid_score_request(), token="")
+        self.assertEqual((api.FORBIDDEN, api.ERROR_BODIES[api.FORBIDDEN]),
+                         self.handle("/method/", json.dumps(request)))
+        self.assertEqual((api.NOT_FOUND, api.ERROR_BODIES[api.NOT_FOUND]), self.handle("/unknown/", "[1]"))
+        code, body = self.handle("/method/", json.dumps(dict(request, method="unknown")))
+        self.assertEqual({"code": api.FORBIDDEN, "error": "Forbidden"}, json.loads(body))
+
+    def test_metrics(self):
+        before = api.get_metrics(None)
+        self.handle("/method/", json.dumps(valid_score_request()))
+        self.handle("/method/", "{")
+        code, body = api.handle_get(api.MainHTTPHandler.get_router, None, "/metrics?x=1")
+        self.assertEqual(api.OK, code)
+        after = json.loads(body)
+        self.assertEqual(before["requests"].get("online_score", 0) + 1, after["requests"]["online_score"])
+        self.assertEqual(before["codes"].get("400", 0) + 1, after["codes"]["400"])
+        stages = after["latency"]["online_score"]
+        self.assertEqual(["auth", "decode", "encode", "handler", "total", "validation"], sorted(stages))
+        self.assertEqual(stages["total"]["count"], sum(c for _, c in stages["total"]["buckets"]))
+        self.assertEqual(api.NOT_FOUND, api.handle_get(api.MainHTTPHandler.get_router, None, "/x")[0])
+
+    def test_histogram(self):
+        histogram = api.Histogram()
+        for value in [0.0001] * 98 + [0.3, 10]:
+            histogram.add(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual((100, 0.0001, 0.5), (snapshot["count"], snapshot["p50"], snapshot["p99"]))
+        self.assertEqual([[0.0001, 98], [0.5, 1], ["+Inf", 1]], snapshot["buckets"])
+        for value in [10] * 3:
+            histogram.add(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual((0.0001, "+Inf"), (snapshot["p50"], snapshot["p99"]))
+        self.assertIsNone(api.Histogram().snapshot()["p50"])
+
+    def test_access_log_sample(self):
+        sample = api.ACCESS_LOG_SAMPLE
+        api.ACCESS_LOG_SAMPLE = 0
+        context = {"request_id": "1"}
+        try:
+            api.handle_request(api.MainHTTPHandler.router, None, "/method/",
+                               {}, json.dumps(valid_score_request()), context)
+        finally:
+            api.ACCESS_LOG_SAMPLE = sample
+        self.assertNotIn("response", context)
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.server = api.KeyValueServer(("localhost", 0), api.make_interests_stub(clients=10, seed=1))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def make_client(self, **kwargs):
+        return api.StoreClient(self.server.server_address, **kwargs)
+
+    def test_lru_cache(self):
+        cache = api.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual([1, None, 3], [cache.get(k) for k in "abc"])
+        cache.set("d", 4, ttl=0)
+        self.assertEqual(None, cache.get("d"))
+
+    def test_client(self):
+        client = self.make_client(pool_size=1)
+        self.assertEqual(self.server.stub.get("i:3"), client.get("i:3"))
+        self.assertEqual(None, client.get("i:10"))
+        client.set("key", 1.5, 60)
+        self.assertEqual(1.5, client.get("key"))
+        self.assertEqual(1, client.pool.qsize())
+
+    @cases([(1, 1), (3, 1), (3, 4), (100, 4)])
+    def test_get_interests_many(self, chunk_size, fan_out):
+        store = api.Store(self.make_client(), chunk_size=chunk_size, fan_out=fan_out)
+        interests = api.get_interests_many(store, [1, 2, 2, 9, 5, 12, 1, 3])
+        self.assertEqual([1, 2, 3, 5, 9, 12], sorted(interests))
+        self.assertEqual([], interests[12])
+        self.assertTrue(all(interests[cid] == api.get_interests(store, cid) for cid in interests))
+
+    def test_timeout(self):
+        self.server.stub.latency = 0.5
+        client = self.make_client(timeout=0.05, retries=2, backoff=0)
+        start = time.time()
+        self.assertRaises(api.StoreError, client.get, "i:1")
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_score_cache(self):
+        store = api.Store(self.make_client())
+        args = {"phone": u"79175002040", "email": u"stupnikov@otus.ru"}
+        self.assertEqual(3.0, api.get_score(store, **args))
+        self.assertEqual(3.0, self.server.stub.get(api.get_score_key(**args)))
+        self.server.stub.set(api.get_score_key(**args), 1.0)
+        self.assertEqual(3.0, api.get_score(store, **args))
+        self.assertEqual(1.0, api.get_score(api.Store(self.make_client()), **args))
+
+    def test_stub_expiring_keys(self):
+        stub = api.KeyValueStub({"i:1": "[]"}, max_expiring=10)
+        for i in range(100):
+            stub.set("s:%d" % i, i, 60)
+        self.assertEqual(11, len(stub.data))
+        self.assertEqual(range(90, 100), [stub.get("s:%d" % i) for i in range(90, 100)])
+        self.assertEqual("[]", stub.get("i:1"))
+        # expired keys are dropped as soon as they are the oldest
+        stub = api.KeyValueStub()
+        stub.set("s:1", 1, -1)
+        stub.set("s:2", 2, 60)
+        self.assertEqual(["s:2"], stub.data.keys())
+
+    def test_store_unavailable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        store = api.Store(self.make_client(retries=1))
+        self.assertEqual(0.5, api.get_score(store, first_name=u"a", last_name=u"b"))
+        self.assertRaises(api.StoreError, api.get_interests, store, 1)
+
+
+class TestServer(unittest.TestCase):
+    def make_server(self):
+        server = api.make_server(("localhost", 0), threads=4)
+        server.start_pool()
+        return server
+
+    def setUp(self):
+        self.server = self.make_server()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def post(self, path, body):
+        conn = httplib.HTTPConnection("localhost", self.server.server_address[1], timeout=5)
+        try:
+            conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+    def test_concurrent_requests(self):
+        request = valid_score_request()
+        results = []
+
+        def worker():
+            for _ in range(5):
+                results.append(self.post("/method/", request)["code"])
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([api.OK] * 40, results)
+
+    def test_not_found(self):
+        self.assertEqual(api.NOT_FOUND, self.post("/unknown/", {"a": 1})["code"])
+
+    def test_metrics(self):
+        self.post("/method/", valid_score_request())
+        conn = httplib.HTTPConnection("localhost", self.server.server_address[1], timeout=5)
+        try:
+            conn.request("GET", "/metrics")
+            response = conn.getresponse()
+            self.assertEqual(api.OK, response.status)
+            self.assertIn("online_score", json.loads(response.read())["requests"])
+        finally:
+            conn.close()
+
+
+class TestAsyncServer(TestServer):
+    def make_server(self):
+        return api.make_server(("localhost", 0), event_loop=True)
+
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection("localhost", self.server.server_address[1], timeout=5)
+        body = json.dumps(valid_score_request())
+        try:
+            for _ in range(3):
+                conn.request("POST", "/method/", body)
+                response = conn.getresponse()
+                self.assertEqual(api.OK, json.loads(response.read())["code"])
+                self.assertFalse(response.will_close)
+        finally:
+            conn.close()
+
+    def test_pipelining(self):
+        body = json.dumps(valid_score_request())
+        request = "POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        bad = "POST /unknown/ HTTP/1.1\r\nContent-Length: 8\r\nConnection: close\r\n\r\n{\"a\": 1}"
+        sock = socket.create_connection(("localhost", self.server.server_address[1]), timeout=5)
+        try:
+            sock.sendall(request + bad + request)
+            data = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+        finally:
+            sock.close()
+        # the connection is closed after the second request, the third is dropped
+        responses = "".join(data).split("HTTP/1.1 ")[1:]
+        self.assertEqual(2, len(responses))
+        self.assertTrue(responses[0].startswith("200 "))
+        self.assertTrue(responses[1].startswith("404 "))
+        self.assertIn("Connection: close", responses[1])
+
+    def test_idle_connection_closed(self):
+        self.server.idle_timeout = 0.2
+        sock = socket.create_connection(("localhost", self.server.server_address[1]), timeout=5)
+        try:
+            start = time.time()
+            self.assertEqual("", sock.recv(1024))
+            self.assertLess(time.time() - start, 3)
+        finally:
+            sock.close()
+
+    def test_max_connections(self):
+        self.server.max_connections = 1
+        body = json.dumps(valid_score_request())
+        request = "POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        first = socket.create_connection(("localhost", self.server.server_address[1]), timeout=5)
+        first.sendall(request)
+        self.assertTrue(first.recv(65536).startswith("HTTP/1.1 200 "))
+        second = socket.create_connection(("localhost", self.server.server_address[1]), timeout=1)
+        try:
+            second.sendall(request)
+            # waits in the backlog until the first connection is gone
+            self.assertRaises(socket.timeout, second.recv, 65536)
+            first.close()
+            second.settimeout(5)
+            self.assertTrue(second.recv(65536).startswith("HTTP/1.1 200 "))
+        finally:
+            first.close()
+            second.close()
+
+    def test_accept_error_backs_off(self):
+        def accept():
+            raise socket.error(errno.EMFILE, "Too many open files")
+
+        self.server.accept = accept
+        self.server.handle_accept()
+        self.assertFalse(self.server.readable())
+        self.server.accept_paused_until = 0
+        self.assertTrue(self.server.readable())
+
+    def test_body_too_large(self):
+        sock = socket.create_connection(("localhost", self.server.server_address[1]), timeout=5)
+        try:
+            sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n{" %
+                         (api.AsyncHTTPChannel.MAX_BODY_SIZE + 1))
+            response = sock.makefile().read()
+        finally:
+            sock.close()
+        self.assertTrue(response.startswith("HTTP/1.1 413 "))
+        self.assertIn("Connection: close", response)
+
+
 if __name__ == "__main__":
     unittest.main()